@@ -3,12 +3,53 @@
 
 A small API to store student records and compute grade averages.
 '''
-from fastapi import FastAPI, HTTPException, Path
+from fastapi import FastAPI, HTTPException, Path, Query, Request
 import fastapi
 from fastapi.responses import JSONResponse
-import json
+from contextlib import asynccontextmanager
+import os
+import sys
 from pydantic import BaseModel, Field, computed_field
 from typing import List, Optional, Dict, Annotated, Literal
+from functools import cached_property
+
+# the record store lives in the repository root and is shared with the patient app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import Store, KeyExists, KeyMissing, RefreshMiddleware
+from compact import Layout
+from changes import changes_response
+from indexes import SortedIndex, NameIndex, text_key
+from responses import stream_format, stream_records, cached_json, ResponseCache
+from metrics import MetricsMiddleware, metrics_response, timer
+
+def grade_for(avg_score):
+    if avg_score >= 90:
+        return "A" 
+    elif avg_score >= 80:
+        return "B"      
+    elif avg_score >= 60:
+        return "C"  
+    elif avg_score >= 35:
+        return "D"
+    else:
+        return "Fail"
+
+def average(scores):
+    return int(sum(scores)/len(scores))
+
+def avg_score_of(record):
+    '''
+    Average score of a stored student, the one saved at write time when it is there.
+
+    Records written before the derived fields were stored only have scores, their average is computed here.
+    '''
+    avg = record.get("avg_score")
+    if isinstance(avg, (int, float)) and not isinstance(avg, bool):
+        return avg
+    scores = record.get("scores")
+    if scores:
+        return average(scores)
+    return None
 
 class Student(BaseModel):
     id : Annotated[str, Field(..., description="ID of the student", examples=["S001"])]
@@ -25,24 +66,16 @@ class Student(BaseModel):
     def max_score(self) -> int:
         return max(self.scores)
     
+    # cached so grade does not re-sum the scores, it is computed once per model
     @computed_field
-    @property
+    @cached_property
     def avg_score(self) -> int:
-        return int(sum(self.scores)/len(self.scores))
+        return average(self.scores)
     
     @computed_field
     @property
     def grade(self) -> str:
-        if self.avg_score >= 90:
-            return "A" 
-        elif self.avg_score >= 80:
-            return "B"      
-        elif self.avg_score >= 60:
-            return "C"  
-        elif self.avg_score >= 35:
-            return "D"
-        else:
-            return "Fail"
+        return grade_for(self.avg_score)
 
 
 class Update_student(BaseModel):
@@ -63,91 +96,188 @@ DELETE /student/{id} → delete record
 
 '''           
 
-app = FastAPI()
+# students as written by Student.model_dump are kept in columns, and in the binary snapshot with STORE_SNAPSHOT=binary
+STUDENT_LAYOUT = Layout([("name", str), ("scores", list), ("user_name", str), ("max_score", int), ("avg_score", int), ("grade", "category")])
 
-def load_data():
-    with open("students.json" , "r") as f:
-        data = json.load(f)
-    return data
-        
-    
-def save_data(data):
-    with open("students.json", "w") as f:
-        json.dump(data, f)
+store = Store.from_env("students.json", table="students", layout=STUDENT_LAYOUT)
+store.add_index("id", SortedIndex())
+# order statistics over the average scores for the leaderboard, built in one pass over all students at load
+store.add_index("avg_score", SortedIndex(avg_score_of))
+# word prefix and trigram index over the names for the typeahead lookup
+store.add_index("name", NameIndex(text_key("name")))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    store.load()
+    yield
+    store.close()
+
+app = FastAPI(lifespan=lifespan)
+# with several workers on a sharded or SQLite store, pick up the other workers' writes before each request
+app.add_middleware(RefreshMiddleware, store=store)
+app.add_middleware(MetricsMiddleware)
+
+# serialized read responses, reused until the store version they were built from changes; the whole list,
+# the queries and the single students in caches of their own, so lookups never evict the list
+list_cache = ResponseCache(max_entries=16)
+query_cache = ResponseCache()
+record_cache = ResponseCache(max_entries=4096)
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
 
 @app.get("/students")
-def view():
-    data = load_data()
-    return data
+async def view(request: Request, limit : Optional[int] = Query(None, gt=0, description="Maximum number of students to return"),
+         cursor : Optional[str] = Query(None, description="X-Next-Cursor header value of the previous page")):
+    fmt = stream_format(request, limit, cursor)
+    if fmt is not None:
+        return await stream_records(store, fmt, limit, cursor)
+    snapshot = store.snapshot()
+    return await cached_json(request, list_cache, store.stamp(snapshot=snapshot), lambda: (snapshot.to_dict(), None))
+
+@app.get("/students/top")
+async def top_students(request: Request, k : int = Query(10, gt=0, le=1000, description="Number of students to return")):
+    '''Leaderboard of the k students with the highest average score.'''
+    def build():
+        page = store.sorted_page("avg_score", limit=k, reverse=True)
+        
+        leaderboard = []
+        for position, ((avg, id), record) in enumerate(page):
+            # students with the same average share a rank
+            rank = leaderboard[-1]["rank"] if leaderboard and leaderboard[-1]["avg_score"] == avg else position + 1
+            leaderboard.append({"rank": rank, "id": id, "name": record.get("name"), "avg_score": avg, "grade": grade_for(avg)})
+        return leaderboard, None
+    return await cached_json(request, query_cache, store.stamp(), build)
+
+@app.get("/students/lookup")
+async def lookup_students(request: Request, q : str = Query(..., min_length=1, description="Name or the start of a name"),
+                    limit : int = Query(10, gt=0, le=100, description="Number of students to return")):
+    '''Typeahead lookup of students by name: whole name and prefix matches first, then word prefixes, then misspellings.'''
+    def build():
+        matches = store.lookup("name", q, limit)
+        return [{"id": id, "match": match, "score": score, **record} for id, match, score, record in matches], None
+    return await cached_json(request, query_cache, store.stamp(), build)
+
+@app.get("/students/changes")
+async def student_changes(request: Request, since : Optional[str] = Query(None, description="`next` of the previous poll or the last event ID, from now when left out"),
+                          limit : int = Query(1000, gt=0, le=10000, description="Maximum number of events per response"),
+                          timeout : float = Query(30, ge=0, le=120, description="Seconds a long poll waits for a change")):
+    '''Create, update and delete events of the students, as Server-Sent Events or a JSON long poll.'''
+    return await changes_response(request, store, since, limit, timeout)
+
+@app.get("/student/{id}/rank")
+async def student_rank(request: Request, id : str = Path(description="Rank of the student based on average score")):
+    # the rank moves whenever any student changes, so it goes by the version of the whole store
+    snapshot = store.snapshot()
+    stamp = store.stamp(snapshot=snapshot)
+    student_data = snapshot.get(id)
+    
+    if student_data is None:
+        raise HTTPException(status_code=404, detail="Student not found in the data")
+    avg = avg_score_of(student_data)
+    if avg is None:
+        raise HTTPException(status_code=404, detail="Scores not found for the student")
+    
+    def position(index):
+        start, stop = index.span(avg, avg)
+        return len(index) - stop, start, len(index)
+    
+    def build():
+        above, below, total = store.query_index("avg_score", position)
+        return {
+            "id": id,
+            "avg_score": avg,
+            "grade": grade_for(avg),
+            "rank": above + 1,
+            "percentile": round(100 * below / total, 2),
+            "total": total,
+        }, None
+    # the index is read under the store lock, so the build goes to the executor rather than waiting on the loop
+    return await cached_json(request, record_cache, stamp, build)
 
 @app.get("/student/{id}")
-def view_student(id : str = Path(description="View students based on ID")):
-    student_data = load_data()
+async def view_student(request: Request, id : str = Path(description="View students based on ID")):
+    snapshot = store.snapshot()
+    stamp = store.stamp(id, snapshot)
+    student_data = snapshot.get(id)
     
-    if id not in student_data:
+    if student_data is None:
         raise HTTPException(status_code=404, detail="Student not found in the data")
-    return student_data[id]
+    return await cached_json(request, record_cache, stamp, lambda: (student_data, None), heavy=False)
 
 @app.get("/student/{id}/subjects")
-def view_student_subjects(id : str):
-    student_data = load_data()
+async def view_student_subjects(request: Request, id : str):
+    snapshot = store.snapshot()
+    stamp = store.stamp(id, snapshot)
+    student_data = snapshot.get(id)
     
-    if id not in student_data:
+    if student_data is None:
         raise HTTPException(status_code=404, detail="Student not found in the data")
-    subject_val = student_data[id].get("subjects")
+    subject_val = student_data.get("subjects")
     
     if subject_val is None:
         raise HTTPException(status_code=404, detail="Subject not found for the student")
-    return subject_val
+    return await cached_json(request, record_cache, stamp, lambda: (subject_val, None), heavy=False)
     
     
 @app.post("/create_student")
-def create_student(student : Student):
-    student_data = load_data()
-    
-    if student.id in student_data:
-        raise HTTPException(status_code=401 , detail="Student is already present in the data")
-    
-    student_data[student.id] = student.model_dump(exclude={"id"})
-    
+async def create_student(student : Student):
     #save the data back to the file
-    save_data(student_data)
+    result = (await store.acommit([("create", student.id, student.model_dump(exclude={"id"}))]))[0]
+    if isinstance(result, KeyExists):
+        raise HTTPException(status_code=401 , detail="Student is already present in the data")
     return JSONResponse(status_code=200, content="Student data added successfully")
     
-@app.put("/update_student/{id}")
-def update_student_data(id, student : Update_student):
-    student_data = load_data()
+def merge_student(student, existing_data):
+    '''
+    Merge an Update_student payload into a stored student and revalidate it.
+
+    A complete stored student only has the derived fields recomputed (all of
+    them, a stored record may carry stale ones), anything else is validated in full.
+
+    :param existing_data: stored student dict, it is copied and never edited in place
+    :type student: Update_student
+    '''
+    current_data = student.model_dump(exclude_unset=True)
     
-    if id not in student_data:
-        raise HTTPException(status_code=404, detail="Given student is not there in the data")
+    if student.id is not None and STUDENT_LAYOUT.fits(existing_data) and None not in current_data.values() and current_data.get("scores", existing_data["scores"]):
+        updated_data = dict(existing_data)
+        for k in ("name", "scores"):
+            if k in current_data:
+                updated_data[k] = current_data[k]
+        updated_data["user_name"] = updated_data["name"] + student.id
+        scores = updated_data["scores"]
+        updated_data["max_score"] = max(scores)
+        updated_data["avg_score"] = average(scores)
+        updated_data["grade"] = grade_for(updated_data["avg_score"])
+        return updated_data
     
-    existing_data = student_data[id]
-    current_data = student.model_dump(exclude_unset=True)
+    existing_data = dict(existing_data)
     
     for k,v in current_data.items():
         existing_data[k] = v
         
     existing_data["id"] = student.id
-    student_pydantic_obj = Student(**existing_data)
-    
-    existing_data = student_pydantic_obj.model_dump(exclude={"id"})
-    
-    student_data[id] = existing_data
+    with timer("validate"):
+        student_pydantic_obj = Student(**existing_data)
     
-    
-    save_data(student_data)
+    return student_pydantic_obj.model_dump(exclude={"id"})
+
+@app.put("/update_student/{id}")
+async def update_student_data(id, student : Update_student):
+    result = (await store.acommit([("update", id, lambda existing_data: merge_student(student, existing_data))]))[0]
+    if isinstance(result, KeyMissing):
+        raise HTTPException(status_code=404, detail="Given student is not there in the data")
+    if result is not None:
+        raise result
     return JSONResponse(status_code=200, content="Student data updated successfully !!")
     
     
 @app.delete("/student/{id}")
-def delete_student(id : str):
-    student_data = load_data()
-    
-    if id not in student_data:
+async def delete_student(id : str):
+    result = (await store.acommit([("delete", id, None)]))[0]
+    if isinstance(result, KeyMissing):
         raise HTTPException(status_code=404, detail="Student not found !!")
     
-    del student_data[id]
-    
-    save_data(student_data)
-    
     return JSONResponse(status_code=200, content=f"Student data for id :- {id} has been deleted")
\ No newline at end of file
@@ -0,0 +1,801 @@
+'''
+Storage backends the Store persists its records through.
+
+A backend has three methods:
+
+* ``load()`` returns every record as a dict keyed by ID.
+* ``write(changes, snapshot)`` persists ``changes``, a list of
+  ``(key, record or None)`` where ``None`` means deleted. ``snapshot()``
+  returns a consistent copy of all records for backends that need the
+  whole data set to write.
+* ``close(snapshot)`` flushes and releases whatever the backend holds.
+
+Backends that other processes write to as well also implement the catch up
+methods of ``Backend``: ``stale()``, ``poll(records, keys)`` and
+``locked(keys)``, the others inherit its no-op versions.
+
+``JsonBackend`` keeps the data in the JSON file the apps have always used
+(or in a binary snapshot next to it, see ``binary.py``),
+``ShardedJsonBackend`` splits it over several JSON files so several worker
+processes can write at once, ``SqliteBackend`` keeps it in a SQLite
+database through SQLAlchemy that several worker processes can share.
+'''
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on Windows, FileLock then only serializes the threads of one process
+    fcntl = None
+
+import binary
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text, create_engine, event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+
+
+class Journal:
+    '''
+    Append-only log of changes, one JSON line per changed record.
+
+    ``fsync_every`` batches the fsync calls: 1 syncs every append, N syncs
+    every N appends and 0 leaves it to the OS.
+    '''
+
+    def __init__(self, path, fsync_every=1):
+        self.path = path
+        self.old_path = path + ".old"
+        self.fsync_every = fsync_every
+        self.pending = 0
+        # reentrant, size takes it too and is read from under it by append
+        self.lock = threading.RLock()
+        self.f = open(self.path, "a+")
+
+    @property
+    def size(self):
+        # from the file rather than our own position, other processes may append to the same journal;
+        # under the lock, a background rotate may be swapping the file right now
+        with self.lock:
+            return os.fstat(self.f.fileno()).st_size
+
+    def append(self, changes):
+        lines = []
+        for key, record in changes:
+            if record is None:
+                entry = {"op": "delete", "id": key}
+            else:
+                entry = {"op": "put", "id": key, "data": record}
+            lines.append(json.dumps(entry) + "\n")
+        with self.lock:
+            if not self.ends_cleanly():
+                # end a torn line left by a crashed writer, so it cannot swallow the entries after it
+                lines.insert(0, "\n")
+            self.f.write("".join(lines))
+            self.f.flush()
+            self.pending += len(changes)
+            if self.fsync_every and self.pending >= self.fsync_every:
+                self.sync()
+
+    def ends_cleanly(self):
+        size = self.size
+        if not size:
+            return True
+        with open(self.path, "rb") as f:
+            f.seek(size - 1)
+            return f.read(1) == b"\n"
+
+    def sync(self):
+        if self.pending:
+            os.fsync(self.f.fileno())
+            self.pending = 0
+
+    def rotate(self):
+        # move the current journal aside so compaction can fold it in while new writes go to a fresh file
+        with self.lock:
+            self.sync()
+            self.f.close()
+            if os.path.exists(self.old_path):
+                # a compaction that failed left its entries in the old journal, add ours behind them instead of replacing it
+                with open(self.path, "rb") as current, open(self.old_path, "ab+") as old:
+                    old.seek(0, os.SEEK_END)
+                    if old.tell():
+                        old.seek(-1, os.SEEK_END)
+                        if old.read(1) != b"\n":
+                            old.write(b"\n")
+                    shutil.copyfileobj(current, old)
+                    old.flush()
+                    os.fsync(old.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+            self.f = open(self.path, "a+")
+
+    def replay(self, records, paths=None):
+        '''Apply the old and the current journal on top of ``records``, return the number of entries.'''
+        count = 0
+        for path in paths or (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                for key, record in decode_entries(f):
+                    if record is None:
+                        records.pop(key, None)
+                    else:
+                        records[key] = record
+                    count += 1
+        return count
+
+    def read_from(self, offset):
+        '''Entries appended after byte ``offset`` as ``(key, record or None)``, and the offset to read on from.'''
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # stop at the last complete line, a line being appended right now is picked up next time
+        end = data.rfind(b"\n") + 1
+        return list(decode_entries(data[:end].splitlines())), offset + end
+
+    def truncate(self):
+        '''Empty the journal in place, for when other processes may hold it open and rotating would strand their appends.'''
+        with self.lock:
+            self.sync()
+            self.f.truncate(0)
+
+    def discard_old(self):
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.f.close()
+
+
+def decode_entries(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # torn line from a crash mid append, it never got acknowledged
+            continue
+        yield entry["id"], entry["data"] if entry["op"] == "put" else None
+
+
+def read_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path, records):
+    # write to a temp file and swap it in, a crash mid dump must not truncate the data;
+    # named per process so two processes writing the same file never share (and remove) one temp file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(records, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileLock:
+    '''
+    Exclusive lock on ``path`` held across threads and processes (an flock plus a thread lock).
+
+    Reentrant within a thread, the flock is taken by the outermost ``with``.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def close(self):
+        with self.thread_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+class Backend:
+    '''
+    Catch up hooks for backends shared with other processes, no-ops by default.
+
+    * ``stale()`` - cheap check whether another process wrote since the last poll.
+    * ``poll(records, keys=None)`` - the ``(key, record or None)`` changes
+      other processes made since the last poll, optionally only for the
+      storage holding ``keys``. ``records`` is the caller's current data.
+    * ``locked(keys)`` - context manager keeping other processes from writing
+      ``keys`` until it exits, so a poll inside it stays current.
+
+    ``shared`` tells whether other processes write to the backend at all.
+    '''
+
+    shared = False
+
+    def stale(self):
+        return False
+
+    def poll(self, records, keys=None):
+        return []
+
+    def locked(self, keys):
+        return nullcontext()
+
+
+class VersionTable:
+    '''
+    Per shard ``(write counter, generation)`` pairs in a small memory-mapped file every worker maps.
+
+    A write bumps the counter of its shard, a write that rewrites the shard
+    file or empties its journal bumps the generation too. Each process keeps
+    its own copy of the pairs it has caught up with, so checking for writes
+    by other processes is one comparison of a few bytes.
+    '''
+
+    SLOT = struct.Struct("<QQ")
+
+    def __init__(self, path, count):
+        size = self.SLOT.size * count
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.seen = bytearray(size)
+
+    def current(self, i):
+        return self.SLOT.unpack_from(self.mm, i * self.SLOT.size)
+
+    def seen_of(self, i):
+        return self.SLOT.unpack_from(self.seen, i * self.SLOT.size)
+
+    def bump(self, i, generation=False):
+        '''Count a write to shard ``i``, called with the shard lock held.'''
+        counter, gen = self.current(i)
+        value = (counter + 1, gen + 1 if generation else gen)
+        self.SLOT.pack_into(self.mm, i * self.SLOT.size, *value)
+        return value
+
+    def mark_seen(self, i, value):
+        self.SLOT.pack_into(self.seen, i * self.SLOT.size, *value)
+
+    def stale(self):
+        return self.mm[:] != self.seen
+
+    def close(self):
+        self.mm.close()
+
+
+class JsonBackend(Backend):
+    '''
+    Records in a JSON file, persisted in one of two modes.
+
+    * ``rewrite`` - the whole JSON document is rewritten on every change.
+    * ``journal`` - every change is appended to ``<file>.journal`` as one
+      small JSON line. The journal is replayed on startup and folded back into
+      the JSON snapshot by a background compaction once it grows past
+      ``compact_bytes``, and on close.
+
+    With ``snapshot_format="binary"`` the snapshot is ``<file>.snap`` in the
+    format of ``binary.py``, columns laid out by ``layout``, and ``load``
+    returns the mapped ``binary.SnapshotFile`` instead of a dict. Whichever
+    of the two snapshot files was written last is converted to the format
+    in use on load, so switching formats back and forth loses nothing.
+
+    The files have one writer: ``load`` takes ``<file>.lock`` for as long as
+    the backend is open and a second process is refused, several worker
+    processes need a ``ShardedJsonBackend`` or a ``SqliteBackend``.
+    '''
+
+    def __init__(self, path, mode="journal", fsync_every=1, compact_bytes=1 << 20, snapshot_format="json", layout=None):
+        if mode not in ("journal", "rewrite"):
+            raise ValueError(f"Unknown store mode {mode!r}")
+        if snapshot_format not in ("json", "binary"):
+            raise ValueError(f"Unknown snapshot format {snapshot_format!r}")
+        self.path = path
+        self.binary_path = os.path.splitext(path)[0] + ".snap"
+        self.snapshot_format = snapshot_format
+        self.layout = layout
+        self.mode = mode
+        self.fsync_every = fsync_every
+        self.compact_bytes = compact_bytes
+        self.journal = None
+        self.compacting = None
+        self.owner = None
+
+    def __repr__(self):
+        return f"JsonBackend({self.path!r}, mode={self.mode!r}, snapshot_format={self.snapshot_format!r})"
+
+    def read_snapshot(self):
+        if self.snapshot_format == "json":
+            return read_json(self.path)
+        snapshot = binary.SnapshotFile(self.binary_path)
+        try:
+            return snapshot.to_dict()
+        finally:
+            snapshot.close()
+
+    def write_snapshot(self, records):
+        if self.snapshot_format == "json":
+            write_json(self.path, records)
+        else:
+            binary.write(self.binary_path, records.items(), self.layout)
+
+    def convert(self):
+        '''Rewrite the snapshot in the format in use when it is missing or the one in the other format is newer.'''
+        def mtime(path):
+            return os.stat(path).st_mtime_ns if os.path.exists(path) else -1
+        json_time, binary_time = mtime(self.path), mtime(self.binary_path)
+        if self.snapshot_format == "binary" and json_time > binary_time:
+            binary.write(self.binary_path, read_json(self.path).items(), self.layout)
+        elif self.snapshot_format == "json" and binary_time > json_time:
+            snapshot = binary.SnapshotFile(self.binary_path)
+            try:
+                write_json(self.path, snapshot.to_dict())
+            finally:
+                snapshot.close()
+
+    def claim(self):
+        '''Lock ``<file>.lock`` until ``close``, raises ``RuntimeError`` when another process holds it.'''
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                raise RuntimeError(f"{self.path} is in use by another process, run several workers with STORE_SHARDS above 1 or STORE_BACKEND=sqlite")
+        self.owner = fd
+
+    def load(self):
+        # a second worker would lose the writes of the first and rotate the journal from under it
+        self.claim()
+        self.convert()
+        records = None
+        if self.mode == "journal":
+            self.journal = Journal(self.path + ".journal", self.fsync_every)
+            if self.journal.size or os.path.exists(self.journal.old_path):
+                # fold whatever a previous run left in the journal (including a torn last line) into the snapshot
+                records = self.read_snapshot()
+                self.journal.replay(records)
+                self.journal.rotate()
+                self.write_snapshot(records)
+                self.journal.discard_old()
+        if self.snapshot_format == "binary":
+            # the store copies the columns straight out of the mapped file, nothing is parsed
+            return binary.SnapshotFile(self.binary_path)
+        return records if records is not None else self.read_snapshot()
+
+    def write(self, changes, snapshot):
+        if self.journal is None:
+            self.write_snapshot(snapshot())
+            return
+        self.journal.append(changes)
+        if self.journal.size >= self.compact_bytes and self.compacting is None:
+            self.compacting = threading.Thread(target=self.background_compact, daemon=True)
+            self.compacting.start()
+
+    def compact(self):
+        '''
+        Fold the journal into the JSON snapshot.
+
+        Works from the files rather than from memory, so it needs nothing from
+        the store and writes that land meanwhile simply go to the fresh journal.
+        '''
+        self.journal.rotate()
+        records = self.read_snapshot()
+        self.journal.replay(records, paths=(self.journal.old_path,))
+        self.write_snapshot(records)
+        self.journal.discard_old()
+
+    def background_compact(self):
+        try:
+            self.compact()
+        finally:
+            self.compacting = None
+
+    def close(self, snapshot):
+        compacting = self.compacting
+        if compacting is not None:
+            compacting.join()
+        if self.journal is not None:
+            self.compact()
+            self.journal.close()
+            self.journal = None
+        if self.owner is not None:
+            os.close(self.owner)
+            self.owner = None
+
+
+class Shard:
+    '''
+    One shard file of a ``ShardedJsonBackend`` with its own journal and lock.
+
+    Every read and write of the files holds the shard lock, so processes
+    sharing the shard never interleave and compaction happens in place
+    (the journal is truncated rather than rotated, another process may
+    have it open).
+
+    ``offset`` is how far into the journal this process has caught up,
+    ``poll`` reads the entries other processes appended after it.
+    '''
+
+    def __init__(self, path, mode, fsync_every, compact_bytes, versions, index):
+        self.path = path
+        self.mode = mode
+        self.compact_bytes = compact_bytes
+        self.versions = versions
+        self.index = index
+        self.offset = 0
+        self.lock = FileLock(path + ".lock")
+        self.journal = Journal(path + ".journal", fsync_every) if mode == "journal" else None
+
+    def read(self):
+        records = read_json(self.path) if os.path.exists(self.path) else {}
+        if self.journal is not None:
+            self.journal.replay(records, paths=(self.journal.path,))
+        return records
+
+    def compact(self):
+        write_json(self.path, self.read())
+        self.journal.truncate()
+        # the journal offsets other processes hold are meaningless now, make them reload the shard
+        return self.versions.bump(self.index, generation=True)
+
+    def stale(self):
+        return self.versions.current(self.index) != self.versions.seen_of(self.index)
+
+    def load(self):
+        with self.lock:
+            records = self.read()
+            if self.journal is not None and self.journal.size:
+                self.compact()
+            self.offset = self.journal.size if self.journal is not None else 0
+            self.versions.mark_seen(self.index, self.versions.current(self.index))
+        return records
+
+    def poll(self, records, owns):
+        '''
+        Changes other processes made to the shard since the last poll, called with the lock held.
+
+        New journal entries are read from ``offset``. After a compaction or a
+        rewrite the shard file is read whole and compared with ``records``,
+        ``owns(key)`` tells the keys of ``records`` that live in this shard.
+        '''
+        now = self.versions.current(self.index)
+        seen = self.versions.seen_of(self.index)
+        if now == seen:
+            return []
+        if self.journal is not None and now[1] == seen[1]:
+            changes, self.offset = self.journal.read_from(self.offset)
+        else:
+            fresh = self.read()
+            changes = [(key, record) for key, record in fresh.items() if records.get(key) != record]
+            changes += [(key, None) for key in records if key not in fresh and owns(key)]
+            self.offset = self.journal.size if self.journal is not None else 0
+        self.versions.mark_seen(self.index, now)
+        return changes
+
+    def write(self, changes):
+        '''Persist ``changes``, called with the lock held.'''
+        up_to_date = not self.stale()
+        if self.journal is None:
+            # read back what the other processes wrote and rewrite only this shard
+            records = self.read()
+            for key, record in changes:
+                if record is None:
+                    records.pop(key, None)
+                else:
+                    records[key] = record
+            write_json(self.path, records)
+            now = self.versions.bump(self.index, generation=True)
+        else:
+            self.journal.append(changes)
+            now = self.versions.bump(self.index)
+            if self.journal.size >= self.compact_bytes:
+                now = self.compact()
+        # skip our own write on the next poll, unless there are entries of others before it still to read
+        if up_to_date:
+            self.offset = self.journal.size if self.journal is not None else 0
+            self.versions.mark_seen(self.index, now)
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                if self.journal.size:
+                    self.compact()
+                self.journal.close()
+        self.lock.close()
+
+    def remove(self):
+        for path in (self.path, self.path + ".journal", self.path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class ShardedJsonBackend(Backend):
+    '''
+    Records spread over ``shards`` JSON files by a stable hash of the ID.
+
+    The shards live in ``<file>.shards/`` next to the JSON file, which seeds
+    them on first start. Each shard has its own journal (or is rewritten on
+    its own in ``rewrite`` mode) and its own file lock, so worker processes
+    writing different shards never wait for each other and a write only
+    touches the shards its records hash to. Changing the number of shards
+    redistributes the records on the next start.
+
+    A ``VersionTable`` shared by the workers tells each of them when another
+    one wrote a shard, ``poll`` then reads just the new journal entries.
+    '''
+
+    shared = True
+
+    def __init__(self, path, shards, mode="journal", fsync_every=1, compact_bytes=1 << 20):
+        if mode not in ("journal", "rewrite"):
+            raise ValueError(f"Unknown store mode {mode!r}")
+        if shards < 1:
+            raise ValueError("A sharded store needs at least one shard")
+        self.path = path
+        self.directory = os.path.splitext(path)[0] + ".shards"
+        self.count = shards
+        self.mode = mode
+        self.fsync_every = fsync_every
+        self.compact_bytes = compact_bytes
+        self.shards = []
+        self.versions = None
+        self.pool = None
+
+    def __repr__(self):
+        return f"ShardedJsonBackend({self.path!r}, shards={self.count}, mode={self.mode!r})"
+
+    def shard_of(self, key):
+        # crc32 rather than hash(), it has to agree between processes and across restarts
+        return zlib.crc32(key.encode("utf-8")) % self.count
+
+    def shard_path(self, i, count):
+        return os.path.join(self.directory, f"{i:03d}-of-{count:03d}.json")
+
+    def open_shards(self, count):
+        versions = VersionTable(os.path.join(self.directory, f"versions-of-{count:03d}"), count)
+        return [Shard(self.shard_path(i, count), self.mode, self.fsync_every, self.compact_bytes, versions, i) for i in range(count)]
+
+    def prepare_layout(self):
+        '''Create the shard files for ``count`` shards, from the JSON file or the previous layout. Called under the layout lock.'''
+        layout_path = os.path.join(self.directory, "layout.json")
+        current = read_json(layout_path)["shards"] if os.path.exists(layout_path) else None
+        if current == self.count:
+            return
+        old_shards = []
+        if current is None:
+            records = read_json(self.path) if os.path.exists(self.path) else {}
+        else:
+            old_shards = self.open_shards(current)
+            records = {}
+            for shard in old_shards:
+                records.update(shard.load())
+        buckets = [{} for _ in range(self.count)]
+        for key, record in records.items():
+            buckets[self.shard_of(key)][key] = record
+        for i, bucket in enumerate(buckets):
+            path = self.shard_path(i, self.count)
+            write_json(path, bucket)
+            # a journal left over from an earlier layout of the same size would be replayed on top
+            if os.path.exists(path + ".journal"):
+                os.remove(path + ".journal")
+        # switching the layout file is the commit point, a crash before it leaves the old layout in use
+        write_json(layout_path, {"shards": self.count})
+        for shard in old_shards:
+            shard.close()
+            shard.remove()
+        if old_shards:
+            old_shards[0].versions.close()
+            os.remove(os.path.join(self.directory, f"versions-of-{current:03d}"))
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        layout_lock = FileLock(os.path.join(self.directory, "layout.lock"))
+        with layout_lock:
+            self.prepare_layout()
+            self.shards = self.open_shards(self.count)
+            self.versions = self.shards[0].versions
+            records = {}
+            for shard in self.shards:
+                records.update(shard.load())
+        layout_lock.close()
+        self.pool = ThreadPoolExecutor(max_workers=min(self.count, 8), thread_name_prefix="shard-writer")
+        return records
+
+    def stale(self):
+        return self.versions.stale()
+
+    def poll(self, records, keys=None):
+        indexes = range(self.count) if keys is None else sorted({self.shard_of(key) for key in keys})
+        changes = []
+        for i in indexes:
+            shard = self.shards[i]
+            if not shard.stale():
+                continue
+            with shard.lock:
+                changes += shard.poll(records, lambda key: self.shard_of(key) == i)
+        return changes
+
+    @contextmanager
+    def locked(self, keys):
+        # always in shard order, two processes locking overlapping shards must not deadlock
+        with ExitStack() as stack:
+            for i in sorted({self.shard_of(key) for key in keys}):
+                stack.enter_context(self.shards[i].lock)
+            yield
+
+    def write(self, changes, snapshot):
+        groups = {}
+        for key, record in changes:
+            groups.setdefault(self.shard_of(key), []).append((key, record))
+        with self.locked(key for key, record in changes):
+            if len(groups) == 1:
+                (i, group), = groups.items()
+                self.shards[i].write(group)
+                return
+            # the shards are independent files, write (and fsync) them side by side while this thread holds their locks
+            for _ in self.pool.map(lambda item: self.shards[item[0]].write(item[1]), groups.items()):
+                pass
+
+    def close(self, snapshot):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+        if self.versions is not None:
+            self.versions.close()
+            self.versions = None
+
+
+class SqliteBackend(Backend):
+    '''
+    Records in a SQLite table through a pooled SQLAlchemy engine.
+
+    Each record is a row holding its JSON. Changes are row level upserts and
+    deletes in one transaction, and WAL mode lets several processes read
+    while one writes. The queries of the apps are served by the store's
+    in-memory indexes, so the table has no columns besides the JSON.
+
+    Several worker processes can share a database file. Every write takes
+    ``<db>.lock`` and stamps the IDs it changed with the next change number
+    in ``<table>_changes``, and bumps a ``VersionTable`` in ``<db>.versions``.
+    ``stale`` compares that table, ``poll`` reads back the records changed
+    after the last change number this process has seen.
+
+    On first start against an empty table the records are imported from
+    ``seed_path``, the JSON file the app used before.
+    '''
+
+    def __init__(self, url, table="records", seed_path=None, pool_size=5):
+        self.url = url
+        self.seed_path = seed_path
+        path = make_url(url).database
+        # an in-memory database is private to its process, there is nobody to catch up with
+        self.shared = bool(path) and path != ":memory:"
+        if self.shared:
+            self.engine = create_engine(url, pool_size=pool_size, max_overflow=pool_size, connect_args={"check_same_thread": False})
+        else:
+            # every connection would open a database of its own, the writer thread and the readers share one
+            self.engine = create_engine(url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", self.configure_connection)
+        metadata = MetaData()
+        self.table = Table(table, metadata, Column("id", String, primary_key=True), Column("data", Text, nullable=False))
+        # change number of the last write of every ID, a deleted ID keeps its entry and has no row in the table
+        self.changes = Table(table + "_changes", metadata, Column("id", String, primary_key=True), Column("seq", Integer, nullable=False, index=True))
+        self.seq = 0
+        self.lock = FileLock(path + ".lock") if self.shared else threading.RLock()
+        self.versions = None
+        self.path = path
+
+    def __repr__(self):
+        return f"SqliteBackend({self.url!r}, table={self.table.name!r})"
+
+    @staticmethod
+    def configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    def load(self):
+        if self.shared:
+            self.versions = VersionTable(self.path + ".versions", 1)
+        # under the lock, so workers starting together do not race to create the tables, only one of them
+        # seeds, and the records and the change number they are at agree
+        with self.lock:
+            self.table.metadata.create_all(self.engine)
+            with self.engine.connect() as conn:
+                records = {key: json.loads(data) for key, data in conn.execute(select(self.table.c.id, self.table.c.data))}
+                self.seq = conn.execute(select(func.coalesce(func.max(self.changes.c.seq), 0))).scalar()
+            if self.versions is not None:
+                self.versions.mark_seen(0, self.versions.current(0))
+            if not records and self.seed_path and os.path.exists(self.seed_path):
+                with open(self.seed_path, "r") as f:
+                    records = json.load(f)
+                self.write(list(records.items()), None)
+        return records
+
+    def stale(self):
+        return self.versions is not None and self.versions.stale()
+
+    def poll(self, records, keys=None):
+        if not self.stale():
+            return []
+        now = self.versions.current(0)
+        joined = self.changes.outerjoin(self.table, self.table.c.id == self.changes.c.id)
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(self.changes.c.id, self.changes.c.seq, self.table.c.data)
+                                .select_from(joined).where(self.changes.c.seq > self.seq)).all()
+        self.seq = max([seq for _, seq, _ in rows], default=self.seq)
+        self.versions.mark_seen(0, now)
+        return [(key, None if data is None else json.loads(data)) for key, seq, data in rows]
+
+    def locked(self, keys):
+        return self.lock
+
+    def write(self, changes, snapshot):
+        puts = [{"id": key, "data": json.dumps(record)} for key, record in changes if record is not None]
+        deletes = [key for key, record in changes if record is None]
+        with self.lock:
+            up_to_date = not self.stale()
+            with self.engine.begin() as conn:
+                # nobody else writes while we hold the lock, the next change number is free
+                seq = conn.execute(select(func.coalesce(func.max(self.changes.c.seq), 0))).scalar() + 1
+                if puts:
+                    stmt = sqlite_insert(self.table)
+                    conn.execute(stmt.on_conflict_do_update(index_elements=[self.table.c.id], set_={"data": stmt.excluded.data}), puts)
+                # chunked to stay under SQLite's limit on bound parameters
+                for i in range(0, len(deletes), 500):
+                    conn.execute(self.table.delete().where(self.table.c.id.in_(deletes[i:i + 500])))
+                stmt = sqlite_insert(self.changes)
+                conn.execute(stmt.on_conflict_do_update(index_elements=[self.changes.c.id], set_={"seq": stmt.excluded.seq}),
+                             [{"id": key, "seq": seq} for key, _ in changes])
+            if self.versions is not None:
+                now = self.versions.bump(0)
+                # skip our own write on the next poll, unless there are writes of others before it still to read
+                if up_to_date:
+                    self.seq = seq
+                    self.versions.mark_seen(0, now)
+
+    def close(self, snapshot):
+        self.engine.dispose()
+        if self.versions is not None:
+            self.versions.close()
+            self.versions = None
+        if self.shared:
+            self.lock.close()
@@ -0,0 +1,303 @@
+'''
+Benchmark every route of the patient and student apps at scaled dataset sizes.
+
+Generates synthetic patients.json / students.json files in a temporary
+directory, starts each app in-process and drives it through an ASGI client
+at a fixed concurrency. For every endpoint it reports throughput, p50/p95/p99
+latency, errors and the peak RSS of the process while the endpoint ran, as
+JSON that can be diffed between runs.
+
+    python bench.py --sizes 1000,100000 --requests 200 --concurrency 16 --output run.json
+    python bench.py --compare before.json run.json
+'''
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CITIES = ["Mumbai", "Delhi", "Bengaluru", "Kolkata", "Chennai", "Hyderabad", "Pune", "Lucknow", "Ahmedabad", "Surat"]
+FIRST_NAMES = ["Aarav", "Diya", "Kabir", "Maya", "Rohan", "Sana", "Vikram", "Neha", "Imran", "Leena"]
+LAST_NAMES = ["Patel", "Sharma", "Nair", "Singh", "Bose", "Desai", "Qureshi", "Jain", "Mehta", "Kapoor"]
+SUBJECTS = ["Math", "Science", "English", "History", "Geography", "Computer"]
+
+
+def verdict_for(bmi):
+    if bmi < 18.5:
+        return "Underweight"
+    elif bmi < 25:
+        return "Normal weight"
+    elif bmi < 30:
+        return "Overweight"
+    return "Obese"
+
+
+def patient(rng, i):
+    weight = round(rng.uniform(40, 120), 1)
+    height = round(rng.uniform(145, 200), 1)
+    bmi = round(weight / ((height / 100) ** 2), 2)
+    return {
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "age": rng.randint(1, 119),
+        "gender": rng.choice(["Male", "Female", "Other"]),
+        "city": rng.choice(CITIES),
+        "weight": weight,
+        "height": height,
+        "bmi": bmi,
+        "verdict": verdict_for(bmi),
+    }
+
+
+def student(rng, i):
+    subjects = rng.sample(SUBJECTS, 4)
+    scores = [rng.randint(20, 100) for _ in subjects]
+    avg = int(sum(scores) / len(scores))
+    return {
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "scores": scores,
+        "subjects": subjects,
+        "user_name": f"student{i}",
+        "max_score": max(scores),
+        "avg_score": avg,
+        "grade": "A" if avg >= 90 else "B" if avg >= 80 else "C" if avg >= 60 else "D" if avg >= 35 else "Fail",
+    }
+
+
+def generate(path, size, make, prefix, seed):
+    rng = random.Random(seed)
+    data = {f"{prefix}{i:07d}": make(rng, i) for i in range(size)}
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return list(data)
+
+
+def new_patient(i, prefix="BENCH"):
+    return {"id": f"{prefix}{i}", "name": "Bench Patient", "age": 40, "gender": "Female", "city": "Pune", "weight": 70, "height": 170}
+
+
+def patient_routes(ids, n):
+    '''``(name, request factory)`` for every patient route, a factory maps the request number to ``(method, url, kwargs)``.'''
+    pick = lambda i: ids[(i * 7919) % len(ids)]
+    batch = 100
+    return [
+        ("GET /", lambda i: ("GET", "/", {})),
+        ("GET /about-us", lambda i: ("GET", "/about-us", {})),
+        ("GET /metrics", lambda i: ("GET", "/metrics", {})),
+        ("GET /patients", lambda i: ("GET", "/patients", {})),
+        # httpx asks for gzip by default, this one measures the uncompressed body
+        ("GET /patients identity", lambda i: ("GET", "/patients", {"headers": {"accept-encoding": "identity"}})),
+        ("GET /patients?limit=100", lambda i: ("GET", "/patients", {"params": {"limit": 100}})),
+        ("GET /patients ndjson", lambda i: ("GET", "/patients", {"headers": {"accept": "application/x-ndjson"}})),
+        ("GET /patients/{id}", lambda i: ("GET", f"/patients/{pick(i)}", {})),
+        ("GET /patients/stats", lambda i: ("GET", "/patients/stats", {})),
+        ("GET /patients/stats?group_by=city", lambda i: ("GET", "/patients/stats", {"params": {"group_by": "city"}})),
+        ("GET /patients/search", lambda i: ("GET", "/patients/search", {"params": {"city": "Pune", "gender": "Female", "min_age": 30, "max_age": 40}})),
+        ("GET /patients/export", lambda i: ("GET", "/patients/export", {})),
+        ("GET /patients/export?format=csv", lambda i: ("GET", "/patients/export", {"params": {"format": "csv"}})),
+        ("GET /patients/lookup", lambda i: ("GET", "/patients/lookup", {"params": {"q": FIRST_NAMES[i % len(FIRST_NAMES)][:3]}})),
+        # second letter dropped, only the trigram matching finds these
+        ("GET /patients/lookup fuzzy", lambda i: ("GET", "/patients/lookup", {"params": {"q": (lambda name: name[0] + name[2:])(LAST_NAMES[i % len(LAST_NAMES)])}})),
+        ("GET /patients/changes", lambda i: ("GET", "/patients/changes", {"params": {"timeout": 0}})),
+        ("GET /sort", lambda i: ("GET", "/sort", {"params": {"sort_by": "age", "order": "Desc"}})),
+        ("GET /sort?limit=50", lambda i: ("GET", "/sort", {"params": {"sort_by": "weight", "limit": 50}})),
+        ("POST /Create", lambda i: ("POST", "/Create", {"json": new_patient(i)})),
+        ("PUT /update/{id}", lambda i: ("PUT", f"/update/{pick(i)}", {"json": {"weight": 60 + i % 40}})),
+        ("DELETE /delete/{id}", lambda i: ("DELETE", f"/delete/BENCH{i}", {})),
+        ("POST /bulk/create", lambda i: ("POST", "/bulk/create", {"json": [new_patient(j, f"BULK{i}-") for j in range(batch)]})),
+        ("POST /patients/import", lambda i: ("POST", "/patients/import", {"content": "\n".join(json.dumps(new_patient(j, f"IMPORT{i}-")) for j in range(batch)), "headers": {"content-type": "application/x-ndjson"}})),
+        ("PUT /bulk/update", lambda i: ("PUT", "/bulk/update", {"json": [{"id": f"BULK{i}-{j}", "age": 50} for j in range(batch)]})),
+        ("POST /bulk/delete", lambda i: ("POST", "/bulk/delete", {"json": [f"BULK{i}-{j}" for j in range(batch)]})),
+    ]
+
+
+def student_routes(ids, n):
+    pick = lambda i: ids[(i * 7919) % len(ids)]
+    return [
+        ("GET /metrics", lambda i: ("GET", "/metrics", {})),
+        ("GET /students", lambda i: ("GET", "/students", {})),
+        ("GET /students?limit=100", lambda i: ("GET", "/students", {"params": {"limit": 100}})),
+        ("GET /students/top", lambda i: ("GET", "/students/top", {"params": {"k": 10}})),
+        ("GET /students/lookup", lambda i: ("GET", "/students/lookup", {"params": {"q": FIRST_NAMES[i % len(FIRST_NAMES)][:3]}})),
+        ("GET /students/changes", lambda i: ("GET", "/students/changes", {"params": {"timeout": 0}})),
+        ("GET /student/{id}", lambda i: ("GET", f"/student/{pick(i)}", {})),
+        ("GET /student/{id}/subjects", lambda i: ("GET", f"/student/{pick(i)}/subjects", {})),
+        ("GET /student/{id}/rank", lambda i: ("GET", f"/student/{pick(i)}/rank", {})),
+        ("POST /create_student", lambda i: ("POST", "/create_student", {"json": {"id": f"BENCH{i}", "name": "Bench Student", "scores": [70, 80, 90]}})),
+        ("PUT /update_student/{id}", lambda i: ("PUT", f"/update_student/{pick(i)}", {"json": {"id": pick(i), "scores": [50 + i % 50, 60]}})),
+        ("DELETE /student/{id}", lambda i: ("DELETE", f"/student/BENCH{i}", {})),
+    ]
+
+
+APPS = {
+    "patients": {"main": os.path.join(ROOT, "main.py"), "data": "patients.json", "prefix": "P", "make": patient, "routes": patient_routes},
+    "students": {"main": os.path.join(ROOT, "Student Score FastAPI", "main.py"), "data": "students.json", "prefix": "S", "make": student, "routes": student_routes},
+}
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # no procfs, fall back to the peak of the whole process so far
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextmanager
+def rss_sampler(interval=0.005):
+    '''Track the highest RSS seen while the block runs, the result is in the yielded dict.'''
+    result = {"peak": current_rss()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            result["peak"] = max(result["peak"], current_rss())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        thread.join()
+        result["peak"] = max(result["peak"], current_rss())
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+async def drive(client, factory, requests, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, url, kwargs = factory(i)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            await response.aread()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+def load_app(name, main_path):
+    # both apps are called main.py, load each under its own module name
+    spec = importlib.util.spec_from_file_location(f"bench_{name}_main", main_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+async def bench_app(name, size, args):
+    config = APPS[name]
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    cwd = os.getcwd()
+    try:
+        ids = generate(os.path.join(workdir, config["data"]), size, config["make"], config["prefix"], args.seed)
+        # the apps open their data files relative to the working directory
+        os.chdir(workdir)
+        app = load_app(name, config["main"])
+        results = []
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for route, factory in config["routes"](ids, args.requests):
+                    if args.routes and not any(r in route for r in args.routes):
+                        continue
+                    with rss_sampler() as rss:
+                        elapsed, latencies, errors = await drive(client, factory, args.requests, args.concurrency)
+                    results.append({
+                        "app": name,
+                        "size": size,
+                        "route": route,
+                        "requests": len(latencies),
+                        "errors": errors,
+                        "throughput_rps": round(len(latencies) / elapsed, 2),
+                        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+                        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                        "peak_rss_mb": round(rss["peak"] / (1 << 20), 1),
+                    })
+                    print(f"{name:8} {size:>9} {route:40} {results[-1]['throughput_rps']:>10} rps  p99 {results[-1]['p99_ms']:>9} ms", file=sys.stderr)
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(before_path, after_path):
+    '''Print the change of throughput and p99 per endpoint between two result files.'''
+    with open(before_path) as f:
+        before = {(r["app"], r["size"], r["route"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    for r in after:
+        old = before.get((r["app"], r["size"], r["route"]))
+        if old is None:
+            continue
+        rps = (r["throughput_rps"] / old["throughput_rps"] - 1) * 100 if old["throughput_rps"] else 0
+        p99 = (r["p99_ms"] / old["p99_ms"] - 1) * 100 if old["p99_ms"] else 0
+        print(f"{r['app']:8} {r['size']:>9} {r['route']:40} rps {rps:+7.1f}%  p99 {p99:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apps", default="patients,students", help="comma separated apps to run")
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated dataset sizes, e.g. 1000,100000,1000000")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--routes", default="", help="comma separated substrings, only run matching routes")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the generated datasets")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.routes = [r for r in args.routes.split(",") if r]
+    sys.path.insert(0, ROOT)
+    results = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        for name in args.apps.split(","):
+            results += asyncio.run(bench_app(name, size, args))
+    report = {
+        "python": sys.version.split()[0],
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith("STORE_")},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+'''
+Versioned binary snapshot of a store's records, read through mmap.
+
+The file holds the records that fit a ``compact.Layout`` column by column,
+so loading it copies columns out of the mapped file instead of parsing
+JSON text:
+
+* a fixed header (magic, format version, record count, schema length),
+* the schema as JSON: the fields with their kinds, the distinct values of
+  every category field and where each section starts,
+* then, every section aligned to 8 bytes:
+
+  * the IDs as ``uint32`` indexes into the string table,
+  * one column per field: ``int64`` for int, ``float64`` for float,
+    ``uint16`` codes for category, ``uint32`` string table indexes for str
+    and for list (kept as JSON text),
+  * the IDs of all records, in columns or not, in the order they were
+    written, as ``uint32`` indexes into the string table (format version 2,
+    a version 1 file has the records in columns first),
+  * the string table: ``uint64`` offsets of the ``n + 1`` string bounds,
+    then the UTF-8 bytes of all strings,
+  * the records that do not fit the layout, as one JSON object.
+
+All numbers are little endian. ``write`` builds a file from JSON records and
+``SnapshotFile.to_dict`` turns one back into them, also from the command line::
+
+    python binary.py patients.json patients.snap main:PATIENT_LAYOUT
+    python binary.py patients.snap patients.json
+'''
+import importlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"RECSNAP\0"
+VERSION = 2
+# versions this code reads
+READS = (1, 2)
+HEADER = struct.Struct("<8sIIQQ")
+
+# file kind of every layout kind, with the array typecode of its column
+KIND_NAMES = {int: "int", float: "float", str: "str", "category": "category", list: "json"}
+TYPECODES = {"int": "q", "float": "d", "category": "H", "str": "I", "json": "I"}
+
+
+def align(n):
+    return (n + 7) & ~7
+
+
+class StringTable:
+    '''Distinct strings of a snapshot being written, each stored once.'''
+
+    def __init__(self):
+        self.index = {}
+        self.parts = []
+
+    def add(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.parts)
+            self.parts.append(value.encode("utf-8"))
+        return i
+
+    def sections(self):
+        offsets = array("Q", [0])
+        total = 0
+        for part in self.parts:
+            total += len(part)
+            offsets.append(total)
+        return offsets, b"".join(self.parts)
+
+
+def little(column):
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def write(path, items, layout=None):
+    '''
+    Write the ``(key, record)`` pairs of ``items`` as a binary snapshot at ``path``.
+
+    Records that fit ``layout`` go into the columns, the others (all of them
+    without a layout) into the JSON section. The file is written next to
+    ``path`` and swapped in, a crash never leaves half a snapshot.
+    '''
+    fields = layout.fields if layout is not None else ()
+    kinds = [KIND_NAMES[kind] for kind in layout.kinds] if layout is not None else []
+    strings = StringTable()
+    ids = array("I")
+    order = array("I")
+    columns = [array(TYPECODES[kind]) for kind in kinds]
+    tables = [{} if kind == "category" else None for kind in kinds]
+    other = {}
+    for key, record in items:
+        order.append(strings.add(key))
+        if layout is None or not layout.fits(record):
+            other[key] = record
+            continue
+        ids.append(strings.add(key))
+        for column, kind, table, value in zip(columns, kinds, tables, record.values()):
+            if kind == "str":
+                value = strings.add(value)
+            elif kind == "json":
+                value = strings.add(json.dumps(value))
+            elif kind == "category":
+                value = table.setdefault(value, len(table))
+            column.append(value)
+    offsets, blob = strings.sections()
+
+    sections = [little(ids)] + [little(column) for column in columns] + [little(order), little(offsets), blob, json.dumps(other).encode("utf-8")]
+    places = []
+    position = 0
+    for section in sections:
+        places.append([position, len(section)])
+        position = align(position + len(section))
+    schema = json.dumps({
+        "fields": [[field, kind] for field, kind in zip(fields, kinds)],
+        "tables": [None if table is None else list(table) for table in tables],
+        "ids": places[0],
+        "columns": places[1:-4],
+        "order": places[-4],
+        "offsets": places[-3],
+        "strings": places[-2],
+        "other": places[-1],
+    }).encode("utf-8")
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(ids), len(schema)))
+        f.write(schema)
+        f.write(b"\0" * (align(f.tell()) - f.tell()))
+        start = f.tell()
+        for section, (offset, _) in zip(sections, places):
+            f.write(b"\0" * (start + offset - f.tell()))
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotFile:
+    '''
+    A binary snapshot mapped into memory.
+
+    ``column(i)`` is the ``i``-th field as a read-only sequence: a view
+    straight into the mapped file for numbers and category codes, a list
+    for strings and JSON values. Call ``close`` when done with it, after
+    dropping every view taken from it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        magic, version, _, self.count, schema_length = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary snapshot")
+        if version not in READS:
+            raise ValueError(f"{path} has snapshot format version {version}, this code reads versions {READS}")
+        schema = json.loads(self.mm[HEADER.size:HEADER.size + schema_length])
+        self.start = align(HEADER.size + schema_length)
+        self.schema = schema
+        self.fields = tuple(field for field, _ in schema["fields"])
+        self.kinds = tuple(kind for _, kind in schema["fields"])
+        self.tables = schema["tables"]
+        self.strings = self.read_strings()
+        offset, length = schema["other"]
+        # the records that did not fit the layout, by ID
+        self.other = json.loads(self.mm[self.start + offset:self.start + offset + length])
+        self.ids = [self.strings[i] for i in self.numbers(schema["ids"], "I")]
+        # the IDs of all records in the order they were written
+        if "order" in schema:
+            self.order = [self.strings[i] for i in self.numbers(schema["order"], "I")]
+        else:
+            self.order = self.ids + list(self.other)
+
+    def numbers(self, place, typecode):
+        offset, length = place
+        view = memoryview(self.mm)[self.start + offset:self.start + offset + length]
+        if sys.byteorder != "little":
+            column = array(typecode, view.tobytes())
+            column.byteswap()
+            view.release()
+            return column
+        column = view.cast(typecode)
+        self.views += [column, view]
+        return column
+
+    def read_strings(self):
+        offsets = self.numbers(self.schema["offsets"], "Q")
+        offset, length = self.schema["strings"]
+        blob = self.mm[self.start + offset:self.start + offset + length]
+        if blob.isascii():
+            # the byte offsets are character offsets as well, slice one decoded string
+            text = blob.decode("ascii")
+            return [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    def column(self, i):
+        kind = self.kinds[i]
+        column = self.numbers(self.schema["columns"][i], TYPECODES[kind])
+        if kind == "str":
+            return [self.strings[j] for j in column]
+        if kind == "json":
+            return [json.loads(self.strings[j]) for j in column]
+        return column
+
+    def matches(self, layout):
+        return self.fields == layout.fields and self.kinds == tuple(KIND_NAMES[kind] for kind in layout.kinds)
+
+    def items(self):
+        return self.to_dict().items()
+
+    def to_dict(self):
+        '''The records as one dict, in the order they were written.'''
+        columns = []
+        for i, table in enumerate(self.tables):
+            column = self.column(i)
+            columns.append(column if table is None else [table[code] for code in column])
+        records = {key: dict(zip(self.fields, values)) for key, values in zip(self.ids, zip(*columns))}
+        records.update(self.other)
+        return {key: records[key] for key in self.order}
+
+    def __len__(self):
+        return self.count + len(self.other)
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.mm.close()
+
+
+def main(argv):
+    '''``python binary.py SRC DST [module:LAYOUT]``, converting JSON to binary or binary to JSON by the extension of DST.'''
+    if len(argv) not in (2, 3):
+        sys.exit(main.__doc__)
+    src, dst = argv[:2]
+    if dst.endswith(".json"):
+        snapshot = SnapshotFile(src)
+        records = snapshot.to_dict()
+        snapshot.close()
+        with open(dst, "w") as f:
+            json.dump(records, f)
+        return
+    layout = None
+    if len(argv) == 3:
+        module, _, name = argv[2].partition(":")
+        layout = getattr(importlib.import_module(module), name)
+    with open(src, "r") as f:
+        records = json.load(f)
+    write(dst, records.items(), layout)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
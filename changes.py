@@ -0,0 +1,196 @@
+'''
+Feed of the create, update and delete events of a Store.
+
+The store publishes every change to its ``ChangeFeed`` once it is persisted.
+The feed keeps the latest ``capacity`` events in a ring buffer, numbered
+with a sequence number that starts over at every load, together with the
+epoch of the load. A consumer resumes from the last ``"<epoch>-<seq>"`` it
+saw and gets 410 Gone when that is no longer in the buffer or comes from
+an earlier epoch, and then reloads in full. Every worker process numbers
+its feed on its own, so a consumer that lands on another worker is told
+410 Gone as well.
+
+``changes_response`` serves the feed as Server-Sent Events
+(``Accept: text/event-stream``) or as a JSON long poll.
+'''
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SSE = "text/event-stream"
+# SSE comment sent while the feed is quiet, keeps proxies from closing the connection
+KEEPALIVE = 15.0
+# how often a waiting reader checks for writes of other worker processes
+REFRESH_EVERY = 0.1
+
+
+class Gone(Exception):
+    '''The position asked for is no longer in the feed.'''
+
+
+class ChangeFeed:
+    '''
+    Ring buffer of ``(seq, op, key, record, time)`` events plus wakeups for waiting readers.
+
+    ``publish`` is called by the store's writer, the readers wait on an
+    ``asyncio.Event`` of their own loop that is set thread safely.
+    '''
+
+    def __init__(self, capacity=10000):
+        self.events = deque(maxlen=capacity)
+        self.epoch = None
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.waiters = set()
+
+    def reset(self, epoch):
+        with self.lock:
+            self.events.clear()
+            self.epoch = epoch
+            self.seq = 0
+        self.wake()
+
+    def publish(self, changes):
+        '''Append ``(op, key, record or None)`` changes and wake the readers.'''
+        if not changes:
+            return
+        now = time.time()
+        with self.lock:
+            for op, key, record in changes:
+                self.seq += 1
+                self.events.append((self.seq, op, key, record, now))
+        self.wake()
+
+    def wake(self):
+        with self.lock:
+            waiters = list(self.waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the loop of a reader that went away is already closed
+                pass
+
+    def position(self, token):
+        '''Sequence number of a ``"<epoch>-<seq>"`` token (``None`` means now), raises ``Gone`` or ``ValueError``.'''
+        if token is None:
+            return self.seq
+        epoch, _, seq = token.rpartition("-")
+        seq = int(seq)
+        if epoch != self.epoch or seq < 0 or seq > self.seq:
+            raise Gone(token)
+        return seq
+
+    def token(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    def since(self, seq, limit=None):
+        '''Events after ``seq``, at most ``limit`` of them.'''
+        with self.lock:
+            first = self.events[0][0] if self.events else self.seq + 1
+            if seq < first - 1:
+                raise Gone(seq)
+            start = seq - first + 1
+            stop = None if limit is None else start + limit
+            return list(islice(self.events, start, stop))
+
+    async def wait(self, seq, timeout):
+        '''Wait until there are events after ``seq``, returns ``False`` on timeout.'''
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self.lock:
+            if self.seq > seq:
+                return True
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+
+async def wait_for_changes(store, seq, timeout):
+    '''
+    Wait until ``store.changes`` has events after ``seq``, returns ``False`` on timeout.
+
+    Writes of other workers only reach the feed once the store catches up
+    with them, so on a backend shared between workers the wait is cut into
+    slices with a catch up in between. Otherwise it is one wait, thousands
+    of waiting readers cost nothing until a write wakes them.
+    '''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        pending = store.refresh()
+        if pending is not None:
+            await asyncio.wrap_future(pending)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return store.changes.seq > seq
+        if await store.changes.wait(seq, min(remaining, REFRESH_EVERY) if store.backend.shared else remaining):
+            return True
+
+
+def event_json(feed, event):
+    seq, op, key, record, at = event
+    return {"seq": feed.token(seq), "op": op, "id": key, "data": record, "time": at}
+
+
+async def sse_stream(request, store, seq, limit):
+    feed = store.changes
+    while True:
+        try:
+            events = feed.since(seq, limit)
+        except Gone:
+            yield "event: gone\ndata: {}\n\n"
+            return
+        if events:
+            chunk = []
+            for event in events:
+                chunk.append(f"id: {feed.token(event[0])}\nevent: {event[1]}\ndata: {json.dumps(event_json(feed, event))}\n\n")
+            seq = events[-1][0]
+            yield "".join(chunk)
+            continue
+        if await request.is_disconnected():
+            return
+        if not await wait_for_changes(store, seq, KEEPALIVE):
+            yield ": keepalive\n\n"
+
+
+async def changes_response(request, store, since=None, limit=1000, timeout=30.0):
+    '''
+    Serve the change feed of ``store`` after position ``since`` (``"<epoch>-<seq>"``, ``None`` for now).
+
+    An ``Accept: text/event-stream`` request gets a Server-Sent Events stream
+    that resumes from ``Last-Event-ID`` when the browser reconnects. Any other
+    request is a long poll: it answers as soon as there are events, or with
+    none after ``timeout`` seconds, and ``next`` is the ``since`` of the next poll.
+    '''
+    feed = store.changes
+    since = request.headers.get("last-event-id", since)
+    try:
+        seq = feed.position(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid position")
+    except Gone:
+        raise HTTPException(status_code=410, detail="Position is no longer in the change feed, reload and start from now")
+    if SSE in request.headers.get("accept", ""):
+        return StreamingResponse(sse_stream(request, store, seq, limit), media_type=SSE, headers={"Cache-Control": "no-cache"})
+    try:
+        events = feed.since(seq, limit)
+        if not events and await wait_for_changes(store, seq, timeout):
+            events = feed.since(seq, limit)
+    except Gone:
+        raise HTTPException(status_code=410, detail="Position is no longer in the change feed, reload and start from now")
+    next_seq = events[-1][0] if events else seq
+    return JSONResponse({"events": [event_json(feed, event) for event in events], "next": feed.token(next_seq)})
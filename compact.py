@@ -0,0 +1,184 @@
+'''
+Compact struct-of-arrays storage for the records of a Store.
+
+A Store keeps its records in the buckets of a ``Snapshot`` (see ``store.py``),
+plain dicts by default. ``Layout`` replaces every bucket by a ``Rows`` block
+that stores the records of a fixed schema column by column: numbers in typed
+``array``s, strings with few distinct values as small integer codes into an
+intern table shared by all blocks, and an ID to row index. A record dict is
+only built when it is read, so a stored patient costs its ID, its name and a
+few dozen bytes of columns instead of a dict repeating every key and value.
+
+A record only goes into the columns when it has exactly the fields of the
+layout, in the same order and of the same types, so that it reads back
+identical. Any other record (older files, extra fields) is kept as it is.
+'''
+from array import array
+
+import numpy as np
+
+from stats import Interned
+
+# array typecodes of the column kinds, categories are codes into an intern table, str and list values are kept as they are
+KINDS = {int: "q", float: "d", "category": "H", str: None, list: None}
+
+
+class Layout:
+    '''
+    Schema of the records kept in columns, called to make an empty ``Rows`` block.
+
+    :param fields: ``(field, kind)`` pairs in the order of the record keys,
+        the kind is ``int``, ``float``, ``str``, ``list`` or ``"category"``
+        (a string with few distinct values, stored as a code)
+    '''
+
+    def __init__(self, fields):
+        self.fields = tuple(field for field, _ in fields)
+        self.kinds = tuple(kind for _, kind in fields)
+        self.tables = tuple(Interned() if kind == "category" else None for kind in self.kinds)
+        self.types = tuple(str if kind == "category" else kind for kind in self.kinds)
+
+    def __call__(self):
+        return Rows(self)
+
+    def sources(self, file):
+        '''
+        The columns of a ``binary.SnapshotFile`` with the same fields, for ``take``.
+
+        Number columns are NumPy views of the mapped file, category codes are
+        translated to the ones of this layout.
+        '''
+        sources = []
+        for i, (kind, table) in enumerate(zip(self.kinds, self.tables)):
+            source = file.column(i)
+            if KINDS[kind] is not None:
+                source = np.frombuffer(source, dtype=KINDS[kind])
+            if table is not None:
+                codes = np.array([table.code(value) for value in file.tables[i]], dtype=np.uint16)
+                source = codes[source]
+            sources.append(source)
+        return sources
+
+    def take(self, ids, sources, rows):
+        '''A ``Rows`` block of the records at ``rows`` (a NumPy index array) of the ``sources`` columns.'''
+        block = Rows(self)
+        positions = rows.tolist()
+        block.ids = list(map(ids.__getitem__, positions))
+        block.row_of = dict(zip(block.ids, range(len(positions))))
+        for i, (kind, source) in enumerate(zip(self.kinds, sources)):
+            typecode = KINDS[kind]
+            if typecode is None:
+                block.columns[i] = list(map(source.__getitem__, positions))
+            else:
+                # one gather and one copy in C, no Python object per value
+                block.columns[i] = array(typecode, source[rows].astype(typecode).tobytes())
+        return block
+
+    def fits(self, record):
+        if tuple(record) != self.fields:
+            return False
+        for value, kind, table in zip(record.values(), self.types, self.tables):
+            if type(value) is not kind:
+                return False
+            # codes are 16 bit, a category with more distinct values than that keeps its records as dicts
+            if table is not None and value not in table.codes and len(table.values) > 0xFFFF:
+                return False
+        return True
+
+
+class Rows:
+    '''
+    One bucket of records in the columns of a ``Layout``, with the mapping interface of a dict.
+
+    Rows are kept dense: a deleted row is filled with the last row. A block
+    is copied before the writer changes it, published blocks are never
+    changed (see ``Draft``).
+    '''
+
+    __slots__ = ("layout", "row_of", "ids", "columns", "other")
+
+    def __init__(self, layout, row_of=None, ids=None, columns=None, other=None):
+        self.layout = layout
+        self.row_of = {} if row_of is None else row_of
+        self.ids = [] if ids is None else ids
+        if columns is None:
+            columns = [[] if KINDS[kind] is None else array(KINDS[kind]) for kind in layout.kinds]
+        self.columns = columns
+        # records that do not fit the layout
+        self.other = {} if other is None else other
+
+    def copy(self):
+        return Rows(self.layout, dict(self.row_of), list(self.ids), [column[:] for column in self.columns], dict(self.other))
+
+    def record(self, row):
+        return dict(zip(self.layout.fields, [
+            column[row] if table is None else table.values[column[row]]
+            for column, table in zip(self.columns, self.layout.tables)
+        ]))
+
+    def decoded(self):
+        '''Every column as a list of values, categories looked up once per column rather than per record.'''
+        return [column if table is None else list(map(table.values.__getitem__, column))
+                for column, table in zip(self.columns, self.layout.tables)]
+
+    def get(self, key, default=None):
+        row = self.row_of.get(key)
+        if row is None:
+            return self.other.get(key, default)
+        return self.record(row)
+
+    def __getitem__(self, key):
+        row = self.row_of.get(key)
+        if row is None:
+            return self.other[key]
+        return self.record(row)
+
+    def __contains__(self, key):
+        return key in self.row_of or key in self.other
+
+    def __len__(self):
+        return len(self.ids) + len(self.other)
+
+    def __iter__(self):
+        yield from self.ids
+        yield from self.other
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        fields = self.layout.fields
+        for key, values in zip(self.ids, zip(*self.decoded())):
+            yield key, dict(zip(fields, values))
+        yield from self.other.items()
+
+    def __setitem__(self, key, record):
+        if not self.layout.fits(record):
+            self.pop(key)
+            self.other[key] = record
+            return
+        self.other.pop(key, None)
+        row = self.row_of.get(key)
+        if row is None:
+            row = self.row_of[key] = len(self.ids)
+            self.ids.append(key)
+            for column in self.columns:
+                column.append(0 if isinstance(column, array) else None)
+        for column, value, table in zip(self.columns, record.values(), self.layout.tables):
+            column[row] = value if table is None else table.code(value)
+
+    def pop(self, key, default=None):
+        row = self.row_of.pop(key, None)
+        if row is None:
+            return self.other.pop(key, default)
+        record = self.record(row)
+        last = len(self.ids) - 1
+        if row != last:
+            for column in self.columns:
+                column[row] = column[last]
+            self.ids[row] = self.ids[last]
+            self.row_of[self.ids[row]] = row
+        self.ids.pop()
+        for column in self.columns:
+            column.pop()
+        return record
@@ -0,0 +1,133 @@
+'''
+Streaming bulk import of NDJSON or CSV request bodies into a Store.
+
+The body is read chunk by chunk as it arrives, rows are validated in chunks
+against a ``TypeAdapter`` built once by the app and committed to the store in large
+blocks, so memory stays bounded by the chunk and block sizes no matter how
+big the upload is. A bad row is reported with its row number and skipped,
+it never aborts the rest of the import.
+
+CSV input needs a header row and one record per line (quoted fields with
+embedded newlines are not supported).
+'''
+import csv
+import json
+
+from pydantic import ValidationError
+
+from metrics import timer
+from responses import offload
+from store import KeyExists
+
+
+async def iter_lines(stream):
+    '''Decoded lines of an async byte stream, without their line endings.'''
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8")
+    if buffer.strip():
+        yield buffer.rstrip(b"\r").decode("utf-8")
+
+
+async def iter_rows(stream, fmt):
+    '''
+    ``(row number, row)`` for every data row of an NDJSON or CSV stream.
+
+    A row that cannot be parsed is yielded as the ``ValueError`` it failed with.
+    '''
+    header = None
+    row_number = 0
+    async for line in iter_lines(stream):
+        if not line.strip():
+            continue
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+                continue
+            row_number += 1
+            # empty cells are left out so the model reports them as missing rather than malformed
+            yield row_number, {k: v for k, v in zip(header, values) if v != ""}
+        else:
+            row_number += 1
+            try:
+                yield row_number, json.loads(line)
+            except ValueError as exc:
+                yield row_number, ValueError(f"Invalid JSON: {exc}")
+
+
+class Importer:
+    '''
+    Validate and commit the rows of one upload.
+
+    :param adapter: ``TypeAdapter(List[model])`` of the pydantic model every row must
+        validate against, built once and shared by the imports rather than per upload
+    :param to_op: turns a validated model into a store ``("create", key, record)`` op
+    :param chunk: rows validated per ``TypeAdapter`` call
+    :param block: validated rows committed to the store per write
+    :param max_errors: row errors kept for the response, the rest are only counted
+    '''
+
+    def __init__(self, store, adapter, to_op, chunk=1000, block=5000, max_errors=1000):
+        self.store = store
+        self.adapter = adapter
+        self.to_op = to_op
+        self.chunk = chunk
+        self.block = block
+        self.max_errors = max_errors
+        self.ops = []
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row_number, key, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row_number, "id": key, "errors": errors})
+
+    def validate(self, rows):
+        with timer("validate"):
+            try:
+                models = self.adapter.validate_python([row for _, row in rows])
+            except ValidationError as exc:
+                # split the chunk into the rows that failed and the ones that can still go in
+                by_row = {}
+                for err in exc.errors(include_url=False, include_context=False):
+                    by_row.setdefault(err["loc"][0], []).append({"loc": list(err["loc"][1:]), "msg": err["msg"]})
+                for i, errors in by_row.items():
+                    row_number, row = rows[i]
+                    self.error(row_number, row.get("id") if isinstance(row, dict) else None, errors)
+                rows = [r for i, r in enumerate(rows) if i not in by_row]
+                models = self.adapter.validate_python([row for _, row in rows])
+        self.ops.extend((row_number, self.to_op(model)) for (row_number, _), model in zip(rows, models))
+
+    async def flush(self):
+        ops, self.ops = self.ops, []
+        results = await self.store.acommit([op for _, op in ops], atomic=False)
+        for (row_number, op), result in zip(ops, results):
+            if result is None:
+                self.imported += 1
+            else:
+                msg = "Already exists with the same ID" if isinstance(result, KeyExists) else str(result)
+                self.error(row_number, op[1], [{"loc": ["id"], "msg": msg}])
+
+    async def run(self, stream, fmt):
+        rows = []
+        async for row_number, row in iter_rows(stream, fmt):
+            if isinstance(row, Exception):
+                self.error(row_number, None, [{"loc": [], "msg": str(row)}])
+                continue
+            rows.append((row_number, row))
+            if len(rows) >= self.chunk:
+                await offload(self.validate, rows)
+                rows = []
+            if len(self.ops) >= self.block:
+                await self.flush()
+        if rows:
+            await offload(self.validate, rows)
+        if self.ops:
+            await self.flush()
+        return {"imported": self.imported, "failed": self.failed, "errors": self.errors}
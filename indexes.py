@@ -0,0 +1,366 @@
+'''
+Secondary indexes kept up to date by the Store on every write.
+
+An index gets ``add(key, record)`` when a record is stored and
+``remove(key, record)`` with the old record when it is replaced or deleted,
+so it never has to rescan the data after the initial build.
+'''
+import base64
+import json
+import math
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+
+
+def field_key(field):
+    '''Key function reading a numeric ``field`` from a record, records without a number are left out of the index.'''
+    def key(record):
+        value = record.get(field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        return None
+    return key
+
+
+def text_key(field):
+    '''Key function reading a string ``field`` from a record.'''
+    def key(record):
+        value = record.get(field)
+        return value if isinstance(value, str) else None
+    return key
+
+
+class _Top:
+    '''Sorts after every ID, so ``(value, TOP)`` sits right after the last entry with ``value``.'''
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+TOP = _Top()
+
+
+class SortedIndex:
+    '''
+    Ordered list of ``(value, id)`` pairs.
+
+    Lookups and page boundaries are found by bisection, so a page of ``k``
+    entries costs O(log N + k) instead of a full sort. Without a ``key``
+    function the index orders the records by their ID.
+    '''
+
+    def __init__(self, key=None):
+        self.key = key
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def value(self, key, record):
+        return key if self.key is None else self.key(record)
+
+    def build(self, records):
+        self.entries = sorted(
+            (value, key) for key, value in ((k, self.value(k, r)) for k, r in records.items()) if value is not None
+        )
+
+    def add(self, key, record):
+        value = self.value(key, record)
+        if value is not None:
+            insort(self.entries, (value, key))
+
+    def remove(self, key, record):
+        value = self.value(key, record)
+        if value is None:
+            return
+        i = bisect_left(self.entries, (value, key))
+        if i < len(self.entries) and self.entries[i] == (value, key):
+            del self.entries[i]
+
+    def span(self, lo=None, hi=None):
+        '''Positions ``[start, stop)`` of the entries with ``lo <= value <= hi``, ``None`` leaves a side open.'''
+        start = 0 if lo is None else bisect_left(self.entries, (lo,))
+        stop = len(self.entries) if hi is None else bisect_right(self.entries, (hi, TOP))
+        return start, max(start, stop)
+
+    def count(self, lo=None, hi=None):
+        start, stop = self.span(lo, hi)
+        return stop - start
+
+    def estimate(self, cond):
+        return self.count(*cond)
+
+    def ids(self, cond):
+        start, stop = self.span(*cond)
+        return [entry[1] for entry in self.entries[start:stop]]
+
+    def matches(self, key, record, cond):
+        lo, hi = cond
+        value = self.value(key, record)
+        return value is not None and (lo is None or value >= lo) and (hi is None or value <= hi)
+
+    def page(self, after=None, limit=None, reverse=False):
+        '''
+        Return up to ``limit`` ``(value, id)`` entries that come after the ``after`` entry.
+
+        ``after`` is the last entry of the previous page (``None`` starts from
+        the beginning) and ``reverse`` walks the index from the largest value.
+        '''
+        entries = self.entries
+        if not reverse:
+            start = 0 if after is None else bisect_right(entries, tuple(after))
+            stop = len(entries) if limit is None else start + limit
+            return entries[start:stop]
+        stop = len(entries) if after is None else bisect_left(entries, tuple(after))
+        start = 0 if limit is None else max(stop - limit, 0)
+        return entries[start:stop][::-1]
+
+
+class HashIndex:
+    '''
+    Map from a field value to the set of IDs having it, for equality filters.
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.buckets = {}
+
+    def build(self, records):
+        self.buckets = {}
+        for key, record in records.items():
+            self.add(key, record)
+
+    def add(self, key, record):
+        value = self.key(record)
+        if value is not None:
+            self.buckets.setdefault(value, set()).add(key)
+
+    def remove(self, key, record):
+        value = self.key(record)
+        bucket = self.buckets.get(value)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[value]
+
+    def estimate(self, cond):
+        return len(self.buckets.get(cond, ()))
+
+    def ids(self, cond):
+        return sorted(self.buckets.get(cond, ()))
+
+    def matches(self, key, record, cond):
+        return self.key(record) == cond
+
+
+def fold(text):
+    '''Lower case, accent free, single spaced form of ``text`` that name lookups compare.'''
+    if text.isascii():
+        return " ".join(text.lower().split())
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.casefold().split())
+
+
+def trigrams(words):
+    grams = set()
+    for word in words:
+        # padded like pg_trgm, so the start of a word weighs more than its middle
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    '''
+    Typeahead index over a text field: word prefixes plus trigram fuzzy matching.
+
+    The folded names and each of their words are kept in sorted lists, so the
+    prefix matches come out of a bisection in name order. Every name is also
+    split into trigrams with a posting set per trigram, so misspelt queries
+    still find names that share most of their trigrams.
+
+    ``lookup`` ranks whole name matches first, then names starting with the
+    query, then names whose words start with the query words, then fuzzy
+    matches by trigram similarity.
+    '''
+
+    def __init__(self, key, threshold=0.3):
+        self.key = key
+        self.threshold = threshold
+        self.names = []
+        self.words = []
+        self.postings = {}
+        self.folded = {}
+        self.sizes = {}
+
+    def __len__(self):
+        return len(self.folded)
+
+    def build(self, records):
+        self.postings = {}
+        self.folded = {}
+        self.sizes = {}
+        names, words = [], []
+        for key, record in records.items():
+            name = self.index_name(key, record)
+            if name is not None:
+                names.append((name, key))
+                words.extend((word, key) for word in set(name.split()))
+        self.names = sorted(names)
+        self.words = sorted(words)
+
+    def index_name(self, key, record):
+        value = self.key(record)
+        if value is None:
+            return None
+        name = fold(value)
+        grams = trigrams(name.split())
+        self.folded[key] = name
+        self.sizes[key] = len(grams)
+        postings = self.postings
+        for gram in grams:
+            bucket = postings.get(gram)
+            if bucket is None:
+                bucket = postings[gram] = set()
+            bucket.add(key)
+        return name
+
+    def add(self, key, record):
+        name = self.index_name(key, record)
+        if name is None:
+            return
+        insort(self.names, (name, key))
+        for word in set(name.split()):
+            insort(self.words, (word, key))
+
+    def remove(self, key, record):
+        name = self.folded.pop(key, None)
+        if name is None:
+            return
+        del self.sizes[key]
+        for entries, value in [(self.names, name)] + [(self.words, word) for word in set(name.split())]:
+            i = bisect_left(entries, (value, key))
+            if i < len(entries) and entries[i] == (value, key):
+                del entries[i]
+        for gram in trigrams(name.split()):
+            bucket = self.postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.postings[gram]
+
+    def prefixed(self, entries, prefix):
+        '''Entries of a sorted list whose value starts with ``prefix``, in order.'''
+        i = bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            yield entries[i]
+            i += 1
+
+    def fuzzy(self, query, limit):
+        grams = trigrams(query.split())
+        if not grams:
+            return []
+        # a name reaching the threshold shares at least `need` trigrams with the query, so it is
+        # in one of the len(grams) - need + 1 smallest posting sets: count the shared trigrams over
+        # those and only probe the few largest sets (the common word starts) for the candidates
+        need = max(1, math.ceil(self.threshold * len(grams)))
+        postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+        split = len(grams) - need + 1
+        common = Counter()
+        for posting in postings[:split]:
+            common.update(posting)
+        large = postings[split:]
+        scored = []
+        for key, shared in common.items():
+            for posting in large:
+                if key in posting:
+                    shared += 1
+            if shared < need:
+                continue
+            score = shared / (len(grams) + self.sizes[key] - shared)
+            if score >= self.threshold:
+                scored.append((-score, self.folded[key], key))
+        scored.sort()
+        return [(key, round(-score, 3)) for score, name, key in scored[:limit]]
+
+    def lookup(self, query, limit=10, fuzzy=True):
+        '''
+        Return up to ``limit`` ``(id, match, score)`` for ``query``, best first.
+
+        ``match`` is ``"exact"``, ``"prefix"``, ``"word"`` or ``"fuzzy"`` and
+        ``score`` the trigram similarity for fuzzy matches (1.0 otherwise).
+        '''
+        query = fold(query)
+        if not query:
+            return []
+        result = []
+        seen = set()
+
+        def take(key, match, score=1.0):
+            if key not in seen:
+                seen.add(key)
+                result.append((key, match, score))
+            return len(result) >= limit
+
+        for name, key in self.prefixed(self.names, query):
+            if take(key, "exact" if name == query else "prefix"):
+                return result
+        # every query word has to start some word of the name, the first one drives the scan
+        first, *others = query.split()
+        for word, key in self.prefixed(self.words, first):
+            if key in seen:
+                continue
+            name_words = self.folded[key].split()
+            if all(any(w.startswith(other) for w in name_words) for other in others):
+                if take(key, "word"):
+                    return result
+        if fuzzy and len(query) >= 3:
+            for key, score in self.fuzzy(query, limit + len(seen)):
+                if take(key, "fuzzy", score):
+                    return result
+        return result
+
+
+def search(records, conditions, limit=None):
+    '''
+    Return ``(id, record)`` pairs matching every ``(index, cond)`` in ``conditions``.
+
+    The condition whose index promises the fewest candidates drives the scan
+    and the others are checked on its candidates only, so the cost follows the
+    size of the smallest candidate set rather than the number of records.
+    '''
+    conditions = sorted(conditions, key=lambda c: c[0].estimate(c[1]))
+    (driver, cond), rest = conditions[0], conditions[1:]
+    result = []
+    for key in driver.ids(cond):
+        record = records.get(key)
+        if record is None:
+            continue
+        if all(index.matches(key, record, c) for index, c in rest):
+            result.append((key, record))
+            if limit is not None and len(result) >= limit:
+                break
+    return result
+
+
+def encode_cursor(entry):
+    '''Opaque pagination token for the last entry of a page.'''
+    return base64.urlsafe_b64encode(json.dumps(list(entry)).encode()).decode()
+
+
+def decode_cursor(token, value_type=(int, float)):
+    '''Inverse of ``encode_cursor``, raises ``ValueError`` for a token we did not hand out.'''
+    try:
+        entry = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(entry, list) or len(entry) != 2:
+        raise ValueError("Invalid cursor")
+    if not isinstance(entry[0], value_type) or isinstance(entry[0], bool) or not isinstance(entry[1], str):
+        raise ValueError("Invalid cursor")
+    return tuple(entry)
@@ -1,8 +1,17 @@
-from fastapi import FastAPI, Path, Query, HTTPException
-from pydantic import BaseModel, Field, computed_field
+from fastapi import FastAPI, Path, Query, HTTPException, Request
+from pydantic import BaseModel, Field, computed_field, ValidationError, TypeAdapter
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
-from typing import Literal, Annotated,Optional
-import json
+from typing import Literal, Annotated,Optional, List
+from contextlib import asynccontextmanager
+from store import Store, KeyExists, KeyMissing, RefreshMiddleware
+from compact import Layout
+from indexes import SortedIndex, HashIndex, NameIndex, field_key, text_key, encode_cursor, decode_cursor
+from responses import stream_format, stream_records, cached_json, ResponseCache
+from stats import PatientColumns, population_stats
+from metrics import MetricsMiddleware, metrics_response, timer
+from importer import Importer
+from changes import changes_response
 
 class Patient(BaseModel):
     id : Annotated[str, Field(..., description="ID of the patient", examples=["P001"])]
@@ -16,20 +25,35 @@ class Patient(BaseModel):
     @computed_field
     @property
     def bmi(self)-> float:
-        return round(self.weight / ((self.height/100) ** 2), 2)
+        return bmi_for(self.weight, self.height)
     
     @computed_field
     @property
     def verdict(self)-> str:
-        bmi_value = self.bmi
-        if bmi_value < 18.5:
-            return "Underweight"
-        elif 18.5 <= bmi_value < 25:
-            return "Normal weight"
-        elif 25 <= bmi_value < 30:
-            return "Overweight"
-        else:
-            return "Obese"
+        return verdict_for(self.bmi)
+
+def bmi_for(weight, height):
+    return round(weight / ((height/100) ** 2), 2)
+
+def verdict_for(bmi_value):
+    if bmi_value < 18.5:
+        return "Underweight"
+    elif 18.5 <= bmi_value < 25:
+        return "Normal weight"
+    elif 25 <= bmi_value < 30:
+        return "Overweight"
+    else:
+        return "Obese"
+
+def bmi_of(record):
+    '''BMI of a stored patient, worked out from weight and height for records saved without it.'''
+    bmi = field_key("bmi")(record)
+    if bmi is not None:
+        return bmi
+    weight, height = field_key("weight")(record), field_key("height")(record)
+    if weight is None or not height:
+        return None
+    return bmi_for(weight, height)
 
 class Update_patient(BaseModel):
     name : Annotated[Optional[str], Field(default=None)]
@@ -38,6 +62,9 @@ class Update_patient(BaseModel):
     city : Annotated[Optional[str], Field(default=None)]                
     weight : Annotated[Optional[float], Field(default=None, gt=0)]
     height : Annotated[Optional[float], Field(default=None, gt=0)]  
+
+class Bulk_update_patient(Update_patient):
+    id : Annotated[str, Field(..., description="ID of the patient to update", examples=["P001"])]
     
 '''
 GET /patients → list all
@@ -52,40 +79,174 @@ DELETE /patients/{id} → delete record
 
 ''' 
    
-app = FastAPI()
+# patients as written by Patient.model_dump are kept in typed columns, gender/city/verdict as codes of an intern table
+PATIENT_LAYOUT = Layout([("name", str), ("age", int), ("gender", "category"), ("city", "category"),
+                         ("weight", float), ("height", float), ("bmi", float), ("verdict", "category")])
+
+# STORE_BACKEND picks the JSON file (default) or SQLite
+store = Store.from_env("patients.json", table="patients", layout=PATIENT_LAYOUT)
+# ordered indexes behind GET /patients paging and GET /sort, kept up to date by the store on every write
+store.add_index("id", SortedIndex())
+store.add_index("age", SortedIndex(field_key("age")))
+store.add_index("weight", SortedIndex(field_key("weight")))
+# hash and sorted secondary indexes behind GET /patients/search
+store.add_index("city", HashIndex(text_key("city")))
+store.add_index("gender", HashIndex(text_key("gender")))
+store.add_index("verdict", HashIndex(text_key("verdict")))
+store.add_index("height", SortedIndex(field_key("height")))
+store.add_index("bmi", SortedIndex(bmi_of))
+# word prefix and trigram index behind GET /patients/lookup
+store.add_index("name", NameIndex(text_key("name")))
+# numpy columns behind GET /patients/stats
+store.add_index("columns", PatientColumns())
 
-def load_data():
-    with open("patients.json", "r" ) as f:
-        data = json.load(f)
-    return data
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # load the patients once, every request is served from memory after this
+    store.load()
+    yield
+    # fold the journal back into patients.json on shutdown
+    store.close()
 
-def save_data(data):
-    with open("patients.json", "w") as f:
-        json.dump(data,f)
+app = FastAPI(lifespan=lifespan)
+# with several workers on a sharded or SQLite store, pick up the other workers' writes before each request
+app.add_middleware(RefreshMiddleware, store=store)
+# per route latency histograms, scraped from /metrics
+app.add_middleware(MetricsMiddleware)
+
+# serialized read responses, reused until the store version they were built from changes; kept in three caches
+# so the many distinct searches and single patients never evict the few whole-collection bodies
+list_cache = ResponseCache(max_entries=16)
+query_cache = ResponseCache()
+record_cache = ResponseCache(max_entries=4096)
+# validator of the import chunks, building it is costly so every import shares this one
+PATIENT_ROWS = TypeAdapter(List[Patient])
+# CSV export columns, the computed bmi and verdict are ignored again on import
+EXPORT_COLUMNS = ["id", "name", "age", "gender", "city", "weight", "height", "bmi", "verdict"]
 
 
 @app.get("/")
-def home():
+async def home():
     return{"message" : f"Welcome to the Patient Detail application! This is the home page."}
 
 @app.get("/about-us")
-def about_us():
+async def about_us():
     return {"message" : "Welcome to our first demo project"}
 
+@app.get("/metrics")
+async def metrics():
+    '''Request latency histograms and counters plus phase timers in Prometheus text format.'''
+    return metrics_response()
+
 @app.get("/patients")
-def view():
-    data = load_data()
-    return data
+async def view(request: Request, limit : Optional[int] = Query(None, gt=0, description="Maximum number of patients to return"),
+         cursor : Optional[str] = Query(None, description="X-Next-Cursor header value of the previous page")):
+    # stream NDJSON or a paged JSON array when asked for, otherwise the whole dict as before
+    fmt = stream_format(request, limit, cursor)
+    if fmt is not None:
+        return await stream_records(store, fmt, limit, cursor)
+    # ETag and body from one snapshot, a write landing in between cannot pair the new tag with the old body
+    snapshot = store.snapshot()
+    return await cached_json(request, list_cache, store.stamp(snapshot=snapshot), lambda: (snapshot.to_dict(), None))
+
+@app.get("/patients/stats")
+async def patient_stats(request: Request, group_by : Optional[Literal["city", "gender"]] = Query(None, description="Break the statistics down by city or gender")):
+    '''
+    Population statistics over BMI, verdict, age, weight and height.
+
+    Computed in vectorized form from the columnar copy the store keeps up to date on every write.
+    '''
+    def build():
+        columns = store.snapshot_index("columns")
+        return population_stats(columns, group_by), None
+    return await cached_json(request, list_cache, store.stamp(), build)
+
+@app.get("/patients/search")
+async def search_patients(request: Request, city : Optional[str] = Query(None, description="City of the patient"),
+                    gender : Optional[Literal["Male", "Female", "Other"]] = Query(None, description="Gender of the patient"),
+                    verdict : Optional[str] = Query(None, description="BMI verdict of the patient", examples=["Overweight"]),
+                    min_age : Optional[int] = Query(None), max_age : Optional[int] = Query(None),
+                    min_weight : Optional[float] = Query(None), max_weight : Optional[float] = Query(None),
+                    min_height : Optional[float] = Query(None), max_height : Optional[float] = Query(None),
+                    min_bmi : Optional[float] = Query(None), max_bmi : Optional[float] = Query(None),
+                    limit : int = Query(100, gt=0, le=10000, description="Maximum number of patients to return")):
+    '''
+    Filter patients by city, gender and verdict and by age, weight, height and BMI ranges (bounds are inclusive).
+
+    Every filter is served by a secondary index, the most selective one is scanned and the rest are checked on its matches.
+    '''
+    conditions = [(name, value) for name, value in (("city", city), ("gender", gender), ("verdict", verdict)) if value is not None]
+    ranges = {"age": (min_age, max_age), "weight": (min_weight, max_weight), "height": (min_height, max_height), "bmi": (min_bmi, max_bmi)}
+    conditions += [(name, bounds) for name, bounds in ranges.items() if bounds != (None, None)]
+    if not conditions:
+        conditions = [("id", (None, None))]
+    
+    def build():
+        result = store.search(conditions, limit)
+        return [{"id": patient_id, **record} for patient_id, record in result], None
+    return await cached_json(request, query_cache, store.stamp(), build)
+
+@app.get("/patients/lookup")
+async def lookup_patients(request: Request, q : str = Query(..., min_length=1, description="Name or the start of a name", examples=["roh meh"]),
+                    limit : int = Query(10, gt=0, le=100, description="Maximum number of patients to return")):
+    '''
+    Typeahead lookup of patients by name, best matches first.
+
+    Whole name and prefix matches come first, then names whose words start with the query words, then misspellings.
+    '''
+    def build():
+        matches = store.lookup("name", q, limit)
+        return [{"id": patient_id, "match": match, "score": score, **record} for patient_id, match, score, record in matches], None
+    return await cached_json(request, query_cache, store.stamp(), build)
+
+@app.get("/patients/changes")
+async def patient_changes(request: Request, since : Optional[str] = Query(None, description="`next` of the previous poll or the last event ID, from now when left out"),
+                          limit : int = Query(1000, gt=0, le=10000, description="Maximum number of events per response"),
+                          timeout : float = Query(30, ge=0, le=120, description="Seconds a long poll waits for a change")):
+    '''
+    Create, update and delete events of the patients.
+
+    Streamed as Server-Sent Events when asked for with ``Accept: text/event-stream``,
+    otherwise a long poll answering as soon as there is a change after ``since``.
+    '''
+    return await changes_response(request, store, since, limit, timeout)
+
+@app.post("/patients/import")
+async def import_patients(request: Request, format : Optional[Literal["ndjson", "csv"]] = Query(None, description="Body format, taken from the Content-Type when not given")):
+    '''
+    Import patients from an NDJSON or CSV request body, read as a stream.
+
+    Rows are validated in chunks and committed in large blocks. A row that fails
+    validation or whose ID already exists is reported with its row number and
+    skipped, the rest of the upload still goes in.
+    '''
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    importer = Importer(store, PATIENT_ROWS, lambda patient: ("create", patient.id, patient.model_dump(exclude={"id"})))
+    try:
+        return await importer.run(request.stream(), format)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid UTF-8")
+
+@app.get("/patients/export")
+async def export_patients(format : Literal["ndjson", "csv"] = Query("ndjson", description="ndjson or csv")):
+    '''Stream every patient in ID order, in a format /patients/import reads back.'''
+    headers = {"Content-Disposition": f'attachment; filename="patients.{format}"'}
+    return await stream_records(store, format, columns=EXPORT_COLUMNS, headers=headers)
 
 @app.get("/patients/{patient_id}")
-def get_patient_details(patient_id : str = Path(..., description="The ID of the patient to retrieve", example="P001")):
-    patient_data = load_data()
-    if patient_id in patient_data:
-        return patient_data[patient_id]
+async def get_patient_details(request: Request, patient_id : str = Path(..., description="The ID of the patient to retrieve", example="P001")):
+    snapshot = store.snapshot()
+    stamp = store.stamp(patient_id, snapshot)
+    patient_data = snapshot.get(patient_id)
+    if patient_data is not None:
+        return await cached_json(request, record_cache, stamp, lambda: (patient_data, None), heavy=False)
     raise HTTPException(status_code=404, detail="Patient not found")
 
 @app.get("/sort")
-def sort_patients(sort_by :str = Query(...,description="Sort on the base of age and weight"), order :str = Query("Asc",description="sort in Asc or Desc")):
+async def sort_patients(request: Request, sort_by :str = Query(...,description="Sort on the base of age and weight"), order :str = Query("Asc",description="sort in Asc or Desc"),
+                  limit : Optional[int] = Query(None, gt=0, description="Maximum number of patients to return"),
+                  cursor : Optional[str] = Query(None, description="X-Next-Cursor header value of the previous page")):
     valid_fields = ["age", "weight"]
     order_list = ["Asc", "Desc"]
     
@@ -97,33 +258,87 @@ def sort_patients(sort_by :str = Query(...,description="Sort on the base of age
     
     sort_order = True if order == "Desc" else False
     
-    data = load_data()
-    result = sorted(data.items(), key=lambda x: x[1][sort_by], reverse=sort_order)
-    return result
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    def build():
+        # read the page straight from the maintained index instead of sorting every patient
+        page = store.sorted_page(sort_by, after=after, limit=limit, reverse=sort_order)
+        headers = {}
+        if limit is not None and len(page) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(page[-1][0])
+        result = [(entry[1], record) for entry, record in page]
+        return result, headers
+    return await cached_json(request, query_cache, store.stamp(), build)
 
-@app.post("/Create")
-def create_patient(patient: Patient):
+def merge_update(patient_id, existing_data, patient):
     '''
-    Docstring for create_patient
-    :type patient: Patient pydantic model
+    Merge an Update_patient payload into a stored patient and revalidate it.
+
+    A complete stored patient (every Patient field, as Patient.model_dump
+    wrote it) was validated when it was written and the payload fields were
+    validated by Update_patient, so only bmi and verdict are recomputed
+    (always, a stored record may carry stale ones). Any other stored
+    patient goes through a full Patient validation.
+
+    :param existing_data: stored patient dict, it is copied and never edited in place
+    :type patient: Update_patient
     '''
-    #load the data
-    data = load_data()
+    # store the updated data for the given patient id in the current_data variable
+    current_data = patient.model_dump(exclude_unset=True, exclude={"id"})
     
-    #check patient id is already exist
-    if patient.id in data:
-        raise HTTPException(status_code=400,detail="Patient already exist with same patient ID")
+    if PATIENT_LAYOUT.fits(existing_data) and None not in current_data.values():
+        updated_data = dict(existing_data)
+        updated_data.update(current_data)
+        updated_data["bmi"] = bmi_for(updated_data["weight"], updated_data["height"])
+        updated_data["verdict"] = verdict_for(updated_data["bmi"])
+        return updated_data
     
-    #Create new patient for new patient ID
-    data[patient.id] = patient.model_dump(exclude={"id"})
+    existing_data = dict(existing_data)
+    
+    # update the existing data with the current data for the given patient id
+    for key, value in current_data.items():
+        existing_data[key] = value 
+        
+    existing_data["id"] = patient_id 
+    with timer("validate"):
+        patient_pydantic_obj = Patient(**existing_data)
     
-    #save the entry of new patient in JSON
-    save_data(data)
+    return patient_pydantic_obj.model_dump(exclude={"id"}) 
+
+def update_op(patient_id, patient):
+    return ("update", patient_id, lambda existing_data: merge_update(patient_id, existing_data, patient))
+
+def raise_for_result(result, missing_detail):
+    # turn a failed store operation into the matching HTTP error
+    if result is None:
+        return
+    if isinstance(result, KeyExists):
+        raise HTTPException(status_code=400,detail="Patient already exist with same patient ID")
+    if isinstance(result, KeyMissing):
+        raise HTTPException(status_code=404, detail=missing_detail)
+    if isinstance(result, ValidationError):
+        raise HTTPException(status_code=422, detail=jsonable_encoder(result.errors(include_url=False, include_context=False)))
+    raise result
+
+@app.post("/Create")
+async def create_patient(patient: Patient):
+    '''
+    Docstring for create_patient
+    :type patient: Patient pydantic model
+    '''
+    #Create new patient for new patient ID and write it through to JSON, fails if patient id is already exist
+    result = (await store.acommit([("create", patient.id, patient.model_dump(exclude={"id"}))]))[0]
+    raise_for_result(result, "Patient not found in the data")
     # return the response after creating the patient data for the given patient id
     return JSONResponse(status_code=201, content="Patient added successfully")
 
 @app.put("/update/{patient_id}")
-def update_patient(patient_id : str, patient: Update_patient):
+async def update_patient(patient_id : str, patient: Update_patient):
     '''
     Docstring for update_patient
     
@@ -132,53 +347,77 @@ def update_patient(patient_id : str, patient: Update_patient):
     :param patient: Description
     :type patient: Update_patient
     '''
-    #load the data
-    data = load_data()
-    #check patient id is already exist
-    if patient_id not in data:
-        raise HTTPException(status_code=404, detail="Patient not found in the data")
-    
-    # load the existing data for the given patient id
-    existing_data = data[patient_id]
-    
-    # store the updated data for the given patient id in the current_data variable
-    current_data = patient.model_dump(exclude_unset=True)
-    
-    # update the existing data with the current data for the given patient id
-    for key, value in current_data.items():
-        existing_data[key] = value 
-        
-    existing_data["id"] = patient_id 
-    patient_pydantic_obj = Patient(**existing_data)
-    
-    existing_data = patient_pydantic_obj.model_dump(exclude={"id"}) 
-    
-    data[patient_id] = existing_data 
-    
-    #save the data after updating the patient data for the given patient id
-    save_data(data)
+    #merge the update into the existing data and save it, fails if patient id is not there
+    result = (await store.acommit([update_op(patient_id, patient)]))[0]
+    raise_for_result(result, "Patient not found in the data")
     
     # return the response after updating the patient data for the given patient id
     return JSONResponse(status_code=200, content="Patient updated successfully")
 
 
 @app.delete("/delete/{patient_id}")
-def delete_patient(patient_id : str):
+async def delete_patient(patient_id : str):
     '''
     Docstring for delete_patient
     
     :param patient_id: Description
     :type patient_id: str
     '''
-    #load the data
-    data = load_data()
-    #check patient id is already exist
-    if patient_id not in data:
-        raise HTTPException(status_code=404, detail="Patient ID not found in data")
-    # delete the patient data for the given patient id
-    del data[patient_id]
-    #save the data after deleting the patient data for the given patient id
-    save_data(data)
+    # delete the patient data for the given patient id and save the data, fails if patient id is not there
+    result = (await store.acommit([("delete", patient_id, None)]))[0]
+    raise_for_result(result, "Patient ID not found in data")
     # return the response after deleting the patient data for the given patient id
     return JSONResponse(status_code=200,content="Patient deleted successfully")
-    
+
+def bulk_results(ids, results, ok_status):
+    '''Per-item outcome of a bulk request, with the status code each item would have got on its own.'''
+    items = []
+    for patient_id, result in zip(ids, results):
+        try:
+            raise_for_result(result, "Patient not found in the data")
+            items.append({"id": patient_id, "status": ok_status, "detail": None})
+        except HTTPException as exc:
+            items.append({"id": patient_id, "status": exc.status_code, "detail": exc.detail})
+    return items
+
+def bulk_response(ids, results, ok_status):
+    # the batch is all or nothing, one failed item rejects the whole batch
+    items = bulk_results(ids, results, ok_status)
+    if any(item["status"] != ok_status for item in items):
+        # nothing was applied, the items that would have gone through did not either
+        for item in items:
+            if item["status"] == ok_status:
+                item["status"], item["detail"] = 409, "Not applied, another item of the batch failed"
+        raise HTTPException(status_code=400, detail=items)
+    return JSONResponse(status_code=ok_status, content=items)
+
+@app.post("/bulk/create")
+async def bulk_create_patients(patients: List[Patient]):
+    '''
+    Create many patients in one atomic commit and a single write to disk.
+
+    :type patients: list of Patient pydantic model
+    '''
+    ops = [("create", patient.id, patient.model_dump(exclude={"id"})) for patient in patients]
+    results = await store.acommit(ops)
+    return bulk_response([patient.id for patient in patients], results, 201)
+
+@app.put("/bulk/update")
+async def bulk_update_patients(patients: List[Bulk_update_patient]):
+    '''
+    Update many patients in one atomic commit and a single write to disk.
+
+    :type patients: list of Bulk_update_patient pydantic model
+    '''
+    results = await store.acommit([update_op(patient.id, patient) for patient in patients])
+    return bulk_response([patient.id for patient in patients], results, 200)
+
+@app.post("/bulk/delete")
+async def bulk_delete_patients(patient_ids: List[str]):
+    '''
+    Delete many patients in one atomic commit and a single write to disk.
+
+    :param patient_ids: IDs of the patients to delete
+    '''
+    results = await store.acommit([("delete", patient_id, None) for patient_id in patient_ids])
+    return bulk_response(patient_ids, results, 200)
@@ -0,0 +1,156 @@
+'''
+Request and phase timing metrics in Prometheus text format.
+
+Every thread records into its own dict of series, so the request path never
+takes a lock; ``/metrics`` adds the per-thread values up when it is scraped.
+
+``MetricsMiddleware`` times every request by route template and status, and
+``timer(phase)`` times the phases inside a request (store load and persist,
+model validation, serialization) into ``app_phase_duration_seconds``.
+'''
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from fastapi.responses import PlainTextResponse
+
+# upper bounds in seconds, the usual Prometheus latency buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    '''
+    Counters and histograms accumulated per thread.
+
+    A series is identified by ``(metric name, label values)``. A counter
+    series is ``[value]``, a histogram series holds one count per bucket,
+    the +Inf count, the sum and the number of observations.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.families = {}
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def register(self, name, kind, help, labels):
+        self.families[name] = (kind, help, tuple(labels))
+
+    def series(self):
+        shard = getattr(self.local, "series", None)
+        if shard is None:
+            shard = self.local.series = {}
+            # only the first observation of a thread takes the lock
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels, value=1):
+        shard = self.series()
+        key = (name, labels)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0]
+        entry[0] += value
+
+    def observe(self, name, labels, seconds):
+        shard = self.series()
+        key = (name, labels)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(self.buckets) + 3)
+        entry[bisect_left(self.buckets, seconds)] += 1
+        entry[-2] += seconds
+        entry[-1] += 1
+
+    def collect(self):
+        totals = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, entry in list(shard.items()):
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(entry)
+                else:
+                    for i, value in enumerate(entry):
+                        total[i] += value
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for name, (kind, help, labelnames) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series_name, labels), entry in sorted(totals.items()):
+                if series_name != name:
+                    continue
+                label_text = ",".join(f'{k}="{escape(v)}"' for k, v in zip(labelnames, labels))
+                if kind == "counter":
+                    lines.append(f"{name}{{{label_text}}} {entry[0]}")
+                    continue
+                sep = "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), entry[:-2]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_text}{sep}le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{label_text}}} {entry[-2]}")
+                lines.append(f"{name}_count{{{label_text}}} {entry[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+REGISTRY.register("http_requests_total", "counter", "HTTP requests by method, route and status.", ("method", "route", "status"))
+REGISTRY.register("http_request_duration_seconds", "histogram", "HTTP request latency by method and route.", ("method", "route"))
+REGISTRY.register("app_phase_duration_seconds", "histogram", "Time spent in the phases of a request.", ("phase",))
+REGISTRY.register("app_coalesced_requests_total", "counter", "Reads that waited for an identical read in flight instead of building their own response.", ())
+
+
+@contextmanager
+def timer(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("app_phase_duration_seconds", (phase,), time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    '''ASGI middleware recording the latency and status of every request under its route template.'''
+
+    def __init__(self, app, registry=REGISTRY):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # the router leaves the matched route in the scope, label by its template to keep the series bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            self.registry.observe("http_request_duration_seconds", (method, route), time.perf_counter() - start)
+            self.registry.inc("http_requests_total", (method, route, str(status)))
+
+
+def metrics_response():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
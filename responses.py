@@ -0,0 +1,330 @@
+'''
+Response helpers shared by the patient and student apps.
+
+The handlers are async and answer from the resident store on the event
+loop. Work that would hold the loop up for long (serializing a large body,
+compressing it, encoding a stream) goes to ``EXECUTOR``, a small bounded
+thread pool, through ``offload``.
+'''
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from indexes import encode_cursor, decode_cursor
+from metrics import REGISTRY, timer
+
+NDJSON = "application/x-ndjson"
+
+# number of records fetched from the store per step while streaming
+STREAM_CHUNK = 500
+# bodies smaller than this go out uncompressed, gzip would save next to nothing on them
+COMPRESS_MIN_BYTES = 1024
+
+# threads for the blocking work of the handlers, sized by APP_EXECUTOR_THREADS
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("APP_EXECUTOR_THREADS", "4")), thread_name_prefix="app-executor")
+
+
+async def offload(fn, *args):
+    '''Run ``fn(*args)`` on ``EXECUTOR`` and wait for it without blocking the event loop.'''
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, fn, *args)
+
+
+async def offloaded(iterator):
+    '''Async iterator over a blocking ``iterator``, every step of it taken on ``EXECUTOR``.'''
+    done = object()
+    iterator = iter(iterator)
+    while True:
+        item = await offload(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def stream_format(request, limit=None, cursor=None):
+    '''
+    Pick how a list endpoint answers.
+
+    ``"ndjson"`` when the client accepts NDJSON, ``"array"`` (a JSON array
+    streamed in chunks) when it asks for a page, ``None`` for the plain
+    whole-collection dict the endpoints have always returned.
+    '''
+    accept = request.headers.get("accept", "")
+    if NDJSON in accept or "application/ndjson" in accept:
+        return "ndjson"
+    if limit is not None or cursor is not None:
+        return "array"
+    return None
+
+
+def iter_records(store, index, after=None, limit=None):
+    '''Yield ``(id, record)`` in the order of ``index``, reading at most ``STREAM_CHUNK`` records at a time.'''
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = STREAM_CHUNK if remaining is None else min(STREAM_CHUNK, remaining)
+        page = store.sorted_page(index, after=after, limit=size)
+        for entry, record in page:
+            yield entry[1], record
+        if len(page) < size:
+            return
+        after = page[-1][0]
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(values)
+    return buffer.getvalue()
+
+
+def encode_records(items, fmt, columns=None, flush_bytes=64 * 1024):
+    '''
+    Serialize ``(id, record)`` items as NDJSON, a JSON array or CSV, yielding the output in blocks of about ``flush_bytes``.
+
+    CSV has a header row of ``columns`` (``"id"`` is the record ID) and
+    leaves out every other field.
+    '''
+    # one send per record makes the ASGI overhead dominate, so records are buffered into bigger blocks
+    if fmt == "csv":
+        parts = [csv_line(columns)]
+    elif fmt == "ndjson":
+        parts = []
+    else:
+        parts = ["["]
+    size = 0
+    first = True
+    started = time.perf_counter()
+    for key, record in items:
+        if fmt == "csv":
+            line = csv_line([key if column == "id" else record.get(column) for column in columns])
+        elif fmt == "ndjson":
+            line = json.dumps({"id": key, **record}) + "\n"
+        else:
+            line = ("" if first else ",") + json.dumps({"id": key, **record})
+        parts.append(line)
+        first = False
+        size += len(line)
+        if size >= flush_bytes:
+            block = "".join(parts).encode()
+            REGISTRY.observe("app_phase_duration_seconds", ("serialize",), time.perf_counter() - started)
+            yield block
+            parts, size = [], 0
+            started = time.perf_counter()
+    if fmt == "array":
+        parts.append("]")
+    if parts:
+        block = "".join(parts).encode()
+        REGISTRY.observe("app_phase_duration_seconds", ("serialize",), time.perf_counter() - started)
+        yield block
+
+
+MEDIA_TYPES = {"ndjson": NDJSON, "array": "application/json", "csv": "text/csv"}
+
+
+async def stream_records(store, fmt, limit=None, cursor=None, index="id", columns=None, headers=None):
+    '''
+    Stream the records of ``store`` in ID order as NDJSON, a JSON array or CSV (see ``encode_records``).
+
+    With a ``limit`` the next page cursor goes out in the ``X-Next-Cursor``
+    header, so the body is never held in memory as a whole.
+    '''
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor, value_type=str)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = dict(headers or {})
+    if limit is not None:
+        # peek at the index entries of the page so the cursor can be sent before the body,
+        # on EXECUTOR as it takes the store lock, which the writer may hold
+        entries = await offload(store.index_page, index, after, limit)
+        if len(entries) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(entries[-1])
+    items = iter_records(store, index, after=after, limit=limit)
+    return StreamingResponse(offloaded(encode_records(items, fmt, columns)), media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
+def dump_json(content):
+    # same encoding as FastAPI's JSONResponse
+    with timer("serialize"):
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def accepts_gzip(request):
+    '''Whether the ``Accept-Encoding`` of ``request`` allows gzip (and does not give it ``q=0``).'''
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        name, _, q = params.strip().partition("=")
+        if name.strip().lower() != "q":
+            return True
+        try:
+            return float(q) > 0
+        except ValueError:
+            return False
+    return False
+
+
+class CachedBody:
+    '''A serialized response body with its extra headers, and the gzip encoding of it made on first use.'''
+
+    __slots__ = ("body", "headers", "gzipped", "lock")
+
+    def __init__(self, body, headers):
+        self.body = body
+        self.headers = headers
+        self.gzipped = None
+        self.lock = threading.Lock()
+
+    def gzip(self):
+        if self.gzipped is None:
+            # concurrent first requests wait for one compression instead of each doing their own
+            with self.lock:
+                if self.gzipped is None:
+                    with timer("compress"):
+                        # a fixed mtime keeps the bytes (and so the cached entry) the same for the same body
+                        self.gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self.gzipped
+
+
+class SingleFlight:
+    '''
+    At most one build in flight per key, concurrent callers with the same key share its outcome.
+
+    The first caller starts ``fn`` on ``EXECUTOR``, the ones arriving while
+    it runs await the same task and get the same result (or exception)
+    instead of repeating the work. The task runs on even if the caller that
+    started it goes away. Only used from the event loop, which needs no lock.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(offload(fn))
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            REGISTRY.inc("app_coalesced_requests_total", ())
+        return await asyncio.shield(task)
+
+
+class ResponseCache:
+    '''
+    Serialized response bodies keyed by request, each valid for one store version.
+
+    Holds at most ``max_entries`` bodies and drops the least recently used.
+    Concurrent misses for the same body are coalesced, one of them builds
+    it and the rest wait for that build (see ``SingleFlight``).
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, etag, value):
+        with self.lock:
+            self.entries[key] = (etag, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def get_or_build(self, key, etag, build, heavy=True):
+        '''
+        The cached value of ``key`` at ``etag``, made with ``build()`` by one caller on a miss.
+
+        A ``heavy`` build runs on ``EXECUTOR``, a light one (a single record)
+        right on the event loop, where the thread hop would cost more than the build.
+        A light build must not take the store lock, the loop would wait on the writer.
+        '''
+        value = self.get(key, etag)
+        if value is not None:
+            return value
+        if not heavy:
+            value = build()
+            self.put(key, etag, value)
+            return value
+
+        def build_once():
+            # a leader that finished just before this one started may have filled the entry already
+            value = self.get(key, etag)
+            if value is None:
+                value = build()
+                self.put(key, etag, value)
+            return value
+        return await self.flights.do((key, etag), build_once)
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole second precision
+        return int(last_modified) <= since
+    return False
+
+
+async def cached_json(request, cache, stamp, build, heavy=True):
+    '''
+    Answer a read with conditional request support and a serialized body cache.
+
+    ``stamp`` is the ``(etag, last_modified)`` pair from ``Store.stamp`` and
+    ``build()`` returns ``(content, headers)`` for the response. A matching
+    ``If-None-Match`` (or ``If-Modified-Since``) gets a 304 without building
+    anything, otherwise the body is serialized once per store version and
+    served from ``cache`` until the data changes. A cached body is answered
+    right on the event loop, building and compressing one runs on ``EXECUTOR``
+    unless ``heavy`` is false (see ``ResponseCache.get_or_build``).
+
+    Bodies of ``COMPRESS_MIN_BYTES`` or more go out gzipped to clients that
+    accept it, compressed once and kept in the cache next to the plain body.
+    The gzipped body carries the weak form of the ETag, so it stays distinct
+    from the plain one while ``If-None-Match`` still matches both.
+    '''
+    etag, last_modified = stamp
+    headers = {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True), "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if not_modified(request, etag, last_modified):
+        if "W/" + etag in request.headers.get("if-none-match", ""):
+            headers["ETag"] = "W/" + etag
+        return Response(status_code=304, headers=headers)
+    def serialize():
+        content, extra_headers = build()
+        return CachedBody(dump_json(content), extra_headers or {})
+    entry = await cache.get_or_build((request.url.path, request.url.query), etag, serialize, heavy)
+    body = entry.body
+    if len(body) >= COMPRESS_MIN_BYTES and accepts_gzip(request):
+        body = entry.gzipped if entry.gzipped is not None else await offload(entry.gzip)
+        headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = "W/" + etag
+    return Response(content=body, media_type="application/json", headers={**headers, **entry.headers})
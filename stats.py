@@ -0,0 +1,169 @@
+'''
+Columnar copy of the patient numbers for population statistics.
+
+``PatientColumns`` is a store index: it keeps age, weight and height in NumPy
+arrays (plus integer codes for city and gender) and is updated on every write,
+so ``/patients/stats`` computes BMI, verdicts, percentiles and group-bys with
+whole-array operations instead of a Python loop over the records.
+'''
+import numpy as np
+
+from indexes import field_key
+
+VERDICTS = ["Underweight", "Normal weight", "Overweight", "Obese"]
+# lower BMI bound of every verdict after the first, same cut-offs as Patient.verdict
+VERDICT_BOUNDS = np.array([18.5, 25.0, 30.0])
+PERCENTILES = [50, 90, 95, 99]
+
+age_key = field_key("age")
+weight_key = field_key("weight")
+height_key = field_key("height")
+
+
+class PatientColumns:
+    '''
+    Struct of arrays over the patients that have a numeric age, weight and height.
+
+    Rows are kept dense: a deleted row is filled with the last row, so every
+    array slice ``[:size]`` is live data.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.row_of = {}
+        self.ids = []
+        self.age = np.zeros(capacity)
+        self.weight = np.zeros(capacity)
+        self.height = np.zeros(capacity)
+        self.city = np.zeros(capacity, dtype=np.int32)
+        self.gender = np.zeros(capacity, dtype=np.int32)
+        self.cities = Interned()
+        self.genders = Interned()
+
+    def build(self, records):
+        self.__init__(max(1024, len(records)))
+        for key, record in records.items():
+            self.add(key, record)
+
+    def grow(self):
+        capacity = len(self.age) * 2
+        for name in ("age", "weight", "height", "city", "gender"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, key, record):
+        age, weight, height = age_key(record), weight_key(record), height_key(record)
+        if age is None or weight is None or not height:
+            return
+        if self.size == len(self.age):
+            self.grow()
+        row = self.size
+        self.age[row] = age
+        self.weight[row] = weight
+        self.height[row] = height
+        self.city[row] = self.cities.code(record.get("city"))
+        self.gender[row] = self.genders.code(record.get("gender"))
+        self.row_of[key] = row
+        self.ids.append(key)
+        self.size += 1
+
+    def remove(self, key, record):
+        row = self.row_of.pop(key, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            for name in ("age", "weight", "height", "city", "gender"):
+                column = getattr(self, name)
+                column[row] = column[last]
+            self.ids[row] = self.ids[last]
+            self.row_of[self.ids[row]] = row
+        self.ids.pop()
+        self.size = last
+
+    def snapshot(self):
+        '''Copy of the live rows, taken under the store lock so stats never see a half-applied write.'''
+        n = self.size
+        return {
+            "age": self.age[:n].copy(),
+            "weight": self.weight[:n].copy(),
+            "height": self.height[:n].copy(),
+            "city": self.city[:n].copy(),
+            "gender": self.gender[:n].copy(),
+            "cities": list(self.cities.values),
+            "genders": list(self.genders.values),
+        }
+
+
+class Interned:
+    '''Table giving each distinct string a small integer code.'''
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        value = "Unknown" if value is None else str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def summary(values):
+    if len(values) == 0:
+        return None
+    result = {
+        "mean": round(float(values.mean()), 2),
+        "min": round(float(values.min()), 2),
+        "max": round(float(values.max()), 2),
+    }
+    for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        result[f"p{p}"] = round(float(value), 2)
+    return result
+
+
+def population_stats(columns, group_by=None):
+    '''
+    Aggregate statistics over a ``PatientColumns.snapshot()``.
+
+    :param group_by: ``"city"`` or ``"gender"`` to add a per group breakdown
+    '''
+    bmi = np.round(columns["weight"] / (columns["height"] / 100) ** 2, 2)
+    verdict = np.searchsorted(VERDICT_BOUNDS, bmi, side="right")
+    result = {
+        "count": int(len(bmi)),
+        "age": summary(columns["age"]),
+        "weight": summary(columns["weight"]),
+        "height": summary(columns["height"]),
+        "bmi": summary(bmi),
+        "verdict": dict(zip(VERDICTS, np.bincount(verdict, minlength=len(VERDICTS)).tolist())),
+    }
+    if group_by is None:
+        return result
+
+    codes = columns[group_by]
+    names = columns["cities" if group_by == "city" else "genders"]
+    groups = len(names)
+    counts = np.bincount(codes, minlength=groups)
+    # divide only where a group still has rows, deleted values leave empty groups behind
+    live = counts > 0
+    means = {}
+    for name, values in (("age", columns["age"]), ("weight", columns["weight"]), ("bmi", bmi)):
+        sums = np.bincount(codes, weights=values, minlength=groups)
+        means[name] = np.round(np.divide(sums, counts, out=np.zeros(groups), where=live), 2)
+    verdicts = np.bincount(codes * len(VERDICTS) + verdict, minlength=groups * len(VERDICTS)).reshape(groups, len(VERDICTS))
+    result["groups"] = {
+        names[code]: {
+            "count": int(counts[code]),
+            "mean_age": float(means["age"][code]),
+            "mean_weight": float(means["weight"][code]),
+            "mean_bmi": float(means["bmi"][code]),
+            "verdict": dict(zip(VERDICTS, verdicts[code].tolist())),
+        }
+        for code in np.flatnonzero(live)
+    }
+    return result
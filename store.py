@@ -0,0 +1,572 @@
+'''
+Process-resident record store shared by the FastAPI apps.
+
+The records are read from the storage backend once when the app starts and
+every read is served from memory. Writes go to memory and are persisted
+through the backend (see ``backends.py``): the JSON file, either rewritten
+or journaled, or a SQLite database.
+
+All writes go through a single writer thread. Concurrent commits that queue
+up while it is busy (or arrive within ``group_window`` seconds) are applied
+together and persisted with one write and one fsync, then made visible and
+every caller is acknowledged. One writer means no lost updates between
+concurrent requests, and a group whose write fails is dropped as a whole.
+
+Readers never wait for the writer: the records are kept in an immutable
+``Snapshot`` and every write publishes a new one, so a reader that took the
+current snapshot (a plain attribute read) can scan it for as long as it
+likes and sees exactly one version, never a half-applied write.
+
+With several worker processes on a sharded store (``STORE_SHARDS``) or a
+SQLite one, each worker first catches up with the writes of the others:
+the writer thread reads them from the shard journals (or by the SQLite
+change numbers) before applying a group, holding the locks of the storage
+it writes, and ``RefreshMiddleware`` has it catch up before a request
+whenever the shared version table shows a write by another worker.
+
+The mode and its knobs are read from the environment by ``Store.from_env``:
+``STORE_BACKEND``, ``STORE_DB_URL``, ``STORE_SHARDS``, ``STORE_SNAPSHOT``, ``STORE_MODE``,
+``STORE_FSYNC_EVERY``, ``STORE_COMPACT_BYTES`` and ``STORE_GROUP_WINDOW``.
+'''
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from binary import SnapshotFile
+from changes import ChangeFeed
+from backends import JsonBackend, ShardedJsonBackend, SqliteBackend
+from indexes import search
+from metrics import timer
+
+
+class KeyExists(KeyError):
+    '''A create was committed for an ID that is already stored.'''
+
+
+class KeyMissing(KeyError):
+    '''An update or delete was committed for an ID that is not stored.'''
+
+
+# number of buckets a Snapshot spreads its records over, a power of two
+SNAPSHOT_BUCKETS = 256
+
+
+def in_order(log, records):
+    '''The keys of ``log`` still in ``records``, each at its last place in the log (a key created again after a delete moves to the end).'''
+    return [key for key in reversed(dict.fromkeys(reversed(log))) if key in records]
+
+
+class Snapshot:
+    '''
+    Immutable mapping of ID to record, one published version of a store.
+
+    The records are spread over ``SNAPSHOT_BUCKETS`` dicts by the hash of the
+    ID. A new version shares every bucket it does not change with the one
+    before, so a write copies only the buckets it touches, and an old version
+    is freed by the garbage collector as soon as the last reader drops it.
+
+    ``layout`` makes an empty bucket, ``dict`` or a ``compact.Layout`` that
+    keeps the records in columns.
+
+    The version of the store it is and the ``(version, modified)`` stamp of
+    every record written since load are part of the snapshot, so an ETag
+    derived from a snapshot always belongs to the records in it.
+
+    ``to_dict`` keeps the order of the file and of the creates, like the
+    plain dict the store used to be, from ``order``: a log of the keys in
+    the order they were stored, shared by the versions and only ever
+    appended to, of which a snapshot sees the first ``order_len``.
+    '''
+
+    __slots__ = ("buckets", "size", "stamps", "version", "modified", "order", "order_len")
+
+    def __init__(self, buckets=None, size=0, layout=dict, stamps=None, version=0, modified=None, order=None, order_len=0):
+        self.buckets = buckets if buckets is not None else tuple(layout() for _ in range(SNAPSHOT_BUCKETS))
+        self.size = size
+        # stamps of the records written since load, spread over buckets like the records
+        self.stamps = stamps if stamps is not None else tuple({} for _ in range(SNAPSHOT_BUCKETS))
+        self.version = version
+        # time of the last write, None until there is one
+        self.modified = modified
+        self.order = order if order is not None else []
+        self.order_len = order_len
+
+    @classmethod
+    def from_dict(cls, records, layout=dict):
+        buckets = tuple(layout() for _ in range(SNAPSHOT_BUCKETS))
+        for key, record in records.items():
+            buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)][key] = record
+        return cls(buckets, len(records), order=list(records), order_len=len(records))
+
+    @classmethod
+    def from_file(cls, file, layout=dict):
+        '''Snapshot of a ``binary.SnapshotFile``, built column by column when its fields are those of ``layout``.'''
+        if not hasattr(layout, "take") or not file.matches(layout):
+            return cls.from_dict(file.to_dict(), layout)
+        # the rows of every bucket, from one stable sort of the rows by bucket
+        of = np.fromiter((hash(key) & (SNAPSHOT_BUCKETS - 1) for key in file.ids), dtype=np.intp, count=len(file.ids))
+        order = np.argsort(of, kind="stable")
+        bounds = np.searchsorted(of[order], np.arange(SNAPSHOT_BUCKETS + 1))
+        sources = layout.sources(file)
+        buckets = tuple(layout.take(file.ids, sources, order[bounds[i]:bounds[i + 1]]) for i in range(SNAPSHOT_BUCKETS))
+        for key, record in file.other.items():
+            buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)][key] = record
+        return cls(buckets, len(file), order=list(file.order), order_len=len(file))
+
+    def get(self, key, default=None):
+        return self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)].get(key, default)
+
+    def stamp(self, key=None):
+        '''``(version, modified)`` of the snapshot, or of the record of ``key``: ``(0, None)`` when untouched since load.'''
+        if key is None:
+            return self.version, self.modified
+        return self.stamps[hash(key) & (SNAPSHOT_BUCKETS - 1)].get(key, (0, None))
+
+    def __getitem__(self, key):
+        return self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)][key]
+
+    def __contains__(self, key):
+        return key in self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def items(self):
+        for bucket in self.buckets:
+            yield from bucket.items()
+
+    def to_dict(self):
+        '''The records as one dict, in the order they were loaded and created.'''
+        records = {}
+        for bucket in self.buckets:
+            records.update(bucket.items())
+        order = self.order[:self.order_len]
+        if len(order) != len(records):
+            # deleted keys are still in the log
+            order = in_order(order, records)
+        return {key: records[key] for key in order}
+
+
+class Draft:
+    '''
+    The next version of a Snapshot while the writer builds it, only ever used by the writer.
+
+    A bucket is copied the first time it is written after a ``publish``,
+    the buckets of the published snapshots are never changed.
+    '''
+
+    def __init__(self, base):
+        self.buckets = list(base.buckets)
+        self.stamps = list(base.stamps)
+        self.size = len(base)
+        # the writer bumps these before installing a group, a stored record is stamped with them
+        self.version = base.version
+        self.modified = base.modified
+        # keys logged by a discarded draft after the last published snapshot are dropped, no snapshot sees them
+        self.order = base.order
+        del self.order[base.order_len:]
+        self.copied = set()
+
+    def get(self, key, default=None):
+        return self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)].get(key, default)
+
+    def __contains__(self, key):
+        return key in self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)]
+
+    def writable(self, key):
+        '''Index of the bucket of ``key``, copied with its stamps first if this draft has not yet.'''
+        i = hash(key) & (SNAPSHOT_BUCKETS - 1)
+        if i not in self.copied:
+            self.buckets[i] = self.buckets[i].copy()
+            self.stamps[i] = dict(self.stamps[i])
+            self.copied.add(i)
+        return i
+
+    def __setitem__(self, key, record):
+        i = self.writable(key)
+        if key not in self.buckets[i]:
+            self.size += 1
+            self.order.append(key)
+        self.buckets[i][key] = record
+        self.stamps[i][key] = (self.version, self.modified)
+
+    def pop(self, key):
+        if key in self.buckets[hash(key) & (SNAPSHOT_BUCKETS - 1)]:
+            self.size -= 1
+            i = self.writable(key)
+            self.stamps[i].pop(key, None)
+            return self.buckets[i].pop(key)
+        return None
+
+    def publish(self):
+        '''Freeze the changes made so far into a new Snapshot, later changes copy their buckets again.'''
+        self.copied = set()
+        if len(self.order) > 2 * self.size + SNAPSHOT_BUCKETS:
+            # mostly deleted keys by now, start a new log, the older snapshots keep reading the old one
+            self.order = in_order(self.order, self)
+        return Snapshot(tuple(self.buckets), self.size, stamps=tuple(self.stamps), version=self.version, modified=self.modified,
+                        order=self.order, order_len=len(self.order))
+
+
+class Store:
+    '''
+    In-memory records keyed by ID, loaded once from a storage backend.
+
+    Records are treated as immutable: an update replaces the stored dict
+    instead of editing it in place, and every write publishes a new
+    ``Snapshot`` in ``records``, so a reader holding a record or a snapshot
+    never sees a half-applied change.
+    '''
+
+    def __init__(self, backend, group_window=0.001, layout=dict):
+        self.backend = backend
+        self.group_window = group_window
+        self.layout = layout
+        # the current version, replaced (never changed) by the writer; draft is where the writer builds the next one
+        self.records = Snapshot(layout=layout)
+        self.draft = Draft(self.records)
+        self.indexes = {}
+        # change tracking for conditional requests: the epoch of the load, the versions are kept in the snapshots
+        self.epoch = None
+        self.loaded = time.time()
+        # create/update/delete events for GET .../changes, published once persisted
+        self.changes = ChangeFeed()
+        self.unpublished = []
+        # (key, old, new) of the draft's changes, applied to the indexes when it is published
+        self.indexing = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.writer = None
+
+    @classmethod
+    def from_env(cls, path, table="records", layout=dict):
+        '''
+        Build a store for the JSON file ``path`` configured from the environment.
+
+        ``STORE_BACKEND=sqlite`` keeps the records in the SQLite database at
+        ``STORE_DB_URL`` (``<file>.db`` next to the JSON file by default) in
+        ``table``, several worker processes can share it.
+        ``STORE_SHARDS`` above 1 splits the JSON file into that many shard
+        files, for running several uvicorn workers (the single JSON file
+        refuses a second worker). ``STORE_SNAPSHOT=binary``
+        keeps the snapshot of the single JSON file store in the binary format
+        of ``binary.py`` for a fast start. ``layout`` is how the records are
+        kept in memory (and in the binary snapshot), see ``Snapshot``.
+        '''
+        options = dict(
+            mode=os.getenv("STORE_MODE", "journal"),
+            fsync_every=int(os.getenv("STORE_FSYNC_EVERY", "1")),
+            compact_bytes=int(os.getenv("STORE_COMPACT_BYTES", str(1 << 20))),
+        )
+        shards = int(os.getenv("STORE_SHARDS", "1"))
+        if os.getenv("STORE_BACKEND", "json") == "sqlite":
+            url = os.getenv("STORE_DB_URL", "sqlite:///" + os.path.splitext(path)[0] + ".db")
+            backend = SqliteBackend(url, table=table, seed_path=path)
+        elif shards > 1:
+            backend = ShardedJsonBackend(path, shards, **options)
+        else:
+            backend = JsonBackend(path, snapshot_format=os.getenv("STORE_SNAPSHOT", "json"), layout=None if layout is dict else layout, **options)
+        return cls(backend, group_window=float(os.getenv("STORE_GROUP_WINDOW", "0.001")), layout=layout)
+
+    def load(self):
+        with timer("store_load"):
+            data = self.backend.load()
+            if isinstance(data, SnapshotFile):
+                try:
+                    records = Snapshot.from_file(data, self.layout)
+                finally:
+                    data.close()
+            else:
+                records = Snapshot.from_dict(data, self.layout)
+        with self.lock:
+            self.records = records
+            self.draft = Draft(self.records)
+            self.indexing = []
+            # a new epoch per load keeps ETags handed out by an earlier process from matching
+            self.epoch = f"{time.time_ns():x}"
+            self.loaded = time.time()
+            for index in self.indexes.values():
+                index.build(self.records)
+            self.changes.reset(self.epoch)
+        self.writer = threading.Thread(target=self.write_loop, name=f"store-writer:{self.backend!r}", daemon=True)
+        self.writer.start()
+        return self
+
+    def close(self):
+        if self.writer is not None:
+            # the sentinel goes in behind every queued commit, they all get written first
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        self.backend.close(self.all)
+
+    def persist(self, changes, snapshot):
+        '''Write ``changes`` (a list of ``(key, record or None)``) to the backend, only ever called by one thread at a time.'''
+        with timer("store_persist"):
+            self.backend.write(changes, snapshot)
+
+    def add_index(self, name, index):
+        with self.lock:
+            index.build(self.records)
+            self.indexes[name] = index
+        return index
+
+    def index_changes(self, key, old, new):
+        for index in self.indexes.values():
+            if old is not None:
+                index.remove(key, old)
+            if new is not None:
+                index.add(key, new)
+
+    def index_page(self, name, after=None, limit=None, reverse=False):
+        with self.lock:
+            return self.indexes[name].page(after, limit, reverse)
+
+    def query_index(self, name, fn):
+        '''Call ``fn(index)`` under the lock so it sees the index between writes.'''
+        with self.lock:
+            return fn(self.indexes[name])
+
+    def search(self, conditions, limit=None):
+        '''
+        Records matching every ``(index name, cond)`` condition, see ``indexes.search``.
+
+        A hash index takes the value to match as ``cond``, a sorted index a ``(lo, hi)`` range.
+        '''
+        with self.lock:
+            return search(self.records, [(self.indexes[name], cond) for name, cond in conditions], limit)
+
+    def lookup(self, name, query, limit=10):
+        '''Best ``limit`` matches of ``query`` in the ``name`` index (a ``NameIndex``) as ``(id, match, score, record)``.'''
+        with self.lock:
+            return [(key, match, score, self.records[key]) for key, match, score in self.indexes[name].lookup(query, limit)]
+
+    def snapshot_index(self, name):
+        with self.lock:
+            return self.indexes[name].snapshot()
+
+    def sorted_page(self, name, after=None, limit=None, reverse=False):
+        '''Return a page of ``(entry, record)`` pairs in the order of the ``name`` index.'''
+        with self.lock:
+            entries = self.indexes[name].page(after, limit, reverse)
+            return [(entry, self.records[entry[1]]) for entry in entries]
+
+    def stamp(self, key=None, snapshot=None):
+        '''
+        ``(etag, last_modified)`` of the whole store, or of one record when ``key`` is given.
+
+        The ETag changes whenever the data it covers does. Pass the
+        ``snapshot`` the body is built from to get the stamp of exactly that
+        version. Without one it is the stamp of the current snapshot, read
+        it before the data so a response is never labelled newer than its body.
+        '''
+        version, modified = (self.records if snapshot is None else snapshot).stamp(key)
+        return f'"{self.epoch}-{version}"', modified if modified is not None else self.loaded
+
+    def snapshot(self):
+        '''The current ``Snapshot`` of the records, it stays the same however long the caller reads it.'''
+        return self.records
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def all(self):
+        # a dict of the current snapshot, built without the lock while writes go on
+        return self.records.to_dict()
+
+    def commit(self, ops, atomic=True):
+        '''
+        Apply a batch of operations and persist them, blocking until they are on disk.
+
+        ``ops`` is a list of ``(op, key, arg)`` tuples:
+
+        * ``("create", key, record)`` - fails with ``KeyExists`` if ``key`` is stored.
+        * ``("update", key, fn)`` - stores ``fn(old_record)``, fails with ``KeyMissing``
+          if ``key`` is not stored. Whatever ``fn`` raises is the result of the op.
+        * ``("delete", key, None)`` - fails with ``KeyMissing`` if ``key`` is not stored.
+
+        The ops see the effects of the ops before them in the same batch.
+        Returns one result per op, ``None`` for success or the exception it
+        failed with. With ``atomic`` a single failure leaves the store
+        untouched, otherwise the successful ops are applied.
+        '''
+        return self.submit(ops, atomic).result()
+
+    async def acommit(self, ops, atomic=True):
+        '''``commit`` for async handlers: waits for the writer thread without holding up the event loop.'''
+        return await asyncio.wrap_future(self.submit(ops, atomic))
+
+    def submit(self, ops, atomic=True):
+        '''Queue ``ops`` for the writer thread and return a ``Future`` of the ``commit`` results.'''
+        future = Future()
+        if self.writer is None:
+            # not started (or already closed), there is nobody to race with so write inline
+            self.write_group([(ops, atomic, future)])
+            return future
+        self.queue.put((ops, atomic, future))
+        return future
+
+    def refresh(self):
+        '''
+        Catch up with the writes other worker processes made through the backend.
+
+        Returns ``None`` when there are none (the common case, one look at the
+        shared version table), otherwise a ``Future`` that is done once the
+        writer thread has applied them.
+        '''
+        if not self.backend.stale():
+            return None
+        return self.submit([])
+
+    def write_loop(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            group = [item]
+            # group commit: take everything already queued plus whatever arrives within the window
+            deadline = time.monotonic() + self.group_window
+            while True:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            self.write_group(group)
+
+    def write_group(self, group):
+        changes = {}
+        outcomes = []
+        keys = {key for ops, atomic, future in group for op, key, arg in ops}
+        try:
+            # only this thread changes the records, so the backend can compare against them without the lock
+            self.apply_external(self.backend.poll(self.records))
+            with self.backend.locked(keys):
+                # nobody else can write these keys now, what the ops see stays current until they are persisted
+                self.apply_external(self.backend.poll(self.records, keys))
+                # the ops (and the update functions with them) run on the draft, the readers do not see it
+                for ops, atomic, future in group:
+                    outcomes.append((future, self.apply(ops, atomic, changes)))
+                pending = self.draft.publish()
+                if changes:
+                    self.persist(list(changes.items()), pending.to_dict)
+                self.publish(pending)
+            self.changes.publish(self.unpublished)
+        except Exception as exc:
+            # nothing of the group was published, the next one starts over from the published snapshot
+            self.draft = Draft(self.records)
+            self.indexing = []
+            for ops, atomic, future in group:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            self.unpublished = []
+        for future, results in outcomes:
+            future.set_result(results)
+
+    def apply_external(self, changes):
+        '''Apply writes made by other processes, already persisted, to memory and the indexes.'''
+        if not changes:
+            return
+        self.draft.version += 1
+        self.draft.modified = time.time()
+        for key, new in changes:
+            self.install(key, new)
+        self.publish(self.draft.publish())
+        # already persisted by the process that made them
+        self.changes.publish(self.unpublished)
+        self.unpublished = []
+
+    def publish(self, snapshot):
+        '''Bring the indexes up to date with the draft and make ``snapshot`` (published from it) current, both at once.'''
+        with self.lock:
+            for key, old, new in self.indexing:
+                self.index_changes(key, old, new)
+            # one reference swap shows the whole group to the readers at once
+            self.records = snapshot
+        self.indexing = []
+
+    def install(self, key, new):
+        '''Replace the record of ``key`` by ``new`` (``None`` deletes it) in the draft, only ever called by the writer.'''
+        old = self.draft.get(key)
+        if old == new:
+            return
+        self.indexing.append((key, old, new))
+        self.unpublished.append(("create" if old is None else "delete" if new is None else "update", key, new))
+        if new is None:
+            self.draft.pop(key)
+        else:
+            self.draft[key] = new
+
+    def apply(self, ops, atomic, changes):
+        '''Apply ``ops`` to the draft and record them in ``changes``, only ever called by the writer.'''
+        pending = {}
+        results = []
+        for op, key, arg in ops:
+            existing = pending[key] if key in pending else self.draft.get(key)
+            try:
+                if op == "create":
+                    if existing is not None:
+                        raise KeyExists(key)
+                    new = arg
+                elif op == "update":
+                    if existing is None:
+                        raise KeyMissing(key)
+                    new = arg(existing)
+                elif op == "delete":
+                    if existing is None:
+                        raise KeyMissing(key)
+                    new = None
+                else:
+                    raise ValueError(f"Unknown operation {op!r}")
+            except Exception as exc:
+                results.append(exc)
+                continue
+            pending[key] = new
+            results.append(None)
+        if not pending or (atomic and any(r is not None for r in results)):
+            return results
+        self.draft.version += 1
+        self.draft.modified = time.time()
+        for key, new in pending.items():
+            self.install(key, new)
+            # later commits in the same group overwrite earlier ones, the last state of a key is what gets written
+            changes.pop(key, None)
+            changes[key] = new
+        return results
+
+
+class RefreshMiddleware:
+    '''ASGI middleware having ``store`` catch up with the other workers' writes before every request.'''
+
+    def __init__(self, app, store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            pending = self.store.refresh()
+            if pending is not None:
+                await asyncio.wrap_future(pending)
+        await self.app(scope, receive, send)
@@ -0,0 +1,187 @@
+'''Regression tests for the in-memory Store.'''
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import binary
+from backends import JsonBackend, SqliteBackend
+from compact import Layout
+from indexes import SortedIndex
+from store import Store
+
+
+class PausingIndex:
+    '''An index that holds the writer up in ``add`` of one key until released, in the middle of a group.'''
+
+    def __init__(self, key):
+        self.key = key
+        self.reached = threading.Event()
+        self.release = threading.Event()
+
+    def build(self, records):
+        pass
+
+    def add(self, key, record):
+        if key == self.key:
+            self.reached.set()
+            self.release.wait(5)
+
+    def remove(self, key, record):
+        pass
+
+
+def test_stamp_is_never_newer_than_the_snapshot(tmp_path):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps({"P001": {"age": 37}, "P002": {"age": 40}}))
+    store = Store(JsonBackend(str(path)))
+    pause = store.add_index("pause", PausingIndex("P002"))
+    store.load()
+    try:
+        before = store.stamp(), store.stamp("P001")
+        future = store.submit([("update", "P001", lambda record: {"age": 11}), ("update", "P002", lambda record: {"age": 12})])
+        assert pause.reached.wait(5)
+        # the writer is between installing the group and publishing it
+        snapshot = store.snapshot()
+        assert (store.stamp(), store.stamp("P001")) == before
+        assert (store.stamp(snapshot=snapshot), store.stamp("P001", snapshot)) == before
+        assert snapshot["P001"] == {"age": 37}
+        pause.release.set()
+        assert future.result(5) == [None, None]
+        snapshot = store.snapshot()
+        assert store.stamp(snapshot=snapshot)[0] != before[0][0]
+        assert store.stamp("P001", snapshot)[0] != before[1][0]
+        assert snapshot["P001"] == {"age": 11}
+    finally:
+        pause.release.set()
+        store.close()
+
+
+def test_to_dict_keeps_load_and_create_order(tmp_path):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps({key: {"n": i} for i, key in enumerate(["P009", "P001", "P005", "P003"])}))
+    store = Store(JsonBackend(str(path)))
+    store.load()
+    try:
+        store.commit([("create", "P000", {"n": 4}), ("delete", "P001", None), ("update", "P005", lambda record: {"n": 5})])
+        store.commit([("delete", "P009", None)])
+        store.commit([("create", "P009", {"n": 6})])
+        assert list(store.all()) == ["P005", "P003", "P000", "P009"]
+    finally:
+        store.close()
+
+
+class FailingBackend(JsonBackend):
+    '''JSON backend whose next ``fail`` writes raise.'''
+
+    fail = 0
+
+    def write(self, changes, snapshot):
+        if self.fail:
+            self.fail -= 1
+            raise OSError("disk full")
+        super().write(changes, snapshot)
+
+
+def test_failed_persist_leaves_the_store_untouched(tmp_path):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps({"P001": {"age": 37}}))
+    store = Store(FailingBackend(str(path)))
+    ids = store.add_index("id", SortedIndex())
+    store.load()
+    try:
+        stamp = store.stamp()
+        store.backend.fail = 1
+        with pytest.raises(OSError):
+            store.commit([("create", "P901", {"age": 20}), ("update", "P001", lambda record: {"age": 11})])
+        assert store.all() == {"P001": {"age": 37}}
+        assert store.stamp() == stamp
+        assert [key for _, key in ids.entries] == ["P001"]
+        assert len(store.changes.since(0)) == 0
+        # the retry is not told the record already exists, and goes through
+        assert store.commit([("create", "P901", {"age": 20})]) == [None]
+        assert list(store.all()) == ["P001", "P901"]
+        assert [key for _, key in ids.entries] == ["P001", "P901"]
+    finally:
+        store.close()
+    assert json.loads(path.read_text()) == {"P001": {"age": 37}, "P901": {"age": 20}}
+
+
+def test_failed_compaction_keeps_its_journal_entries(tmp_path, monkeypatch):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps({}))
+    store = Store(JsonBackend(str(path)))
+    store.load()
+    try:
+        store.commit([("create", "A", {"n": 1})])
+        write_snapshot = store.backend.write_snapshot
+
+        def full_disk(records):
+            raise OSError("disk full")
+        monkeypatch.setattr(store.backend, "write_snapshot", full_disk)
+        with pytest.raises(OSError):
+            store.backend.compact()
+        monkeypatch.setattr(store.backend, "write_snapshot", write_snapshot)
+        store.commit([("create", "B", {"n": 2})])
+        store.backend.compact()
+        assert json.loads(path.read_text()) == {"A": {"n": 1}, "B": {"n": 2}}
+    finally:
+        store.close()
+    assert json.loads(path.read_text()) == {"A": {"n": 1}, "B": {"n": 2}}
+
+
+def increment(path, start, count):
+    '''One worker process: open the SQLite store of ``path`` together with the others and add ``count`` to the age of P001.'''
+    os.environ["STORE_BACKEND"] = "sqlite"
+    store = Store.from_env(path, table="patients")
+    start.wait(10)
+    store.load()
+    try:
+        for _ in range(count):
+            assert store.commit([("update", "P001", lambda record: {**record, "age": record["age"] + 1})]) == [None]
+    finally:
+        store.close()
+
+
+def test_sqlite_workers_starting_together_on_a_new_database(tmp_path):
+    path = tmp_path / "patients.json"
+    path.write_text(json.dumps({"P001": {"age": 37}}))
+    context = multiprocessing.get_context("spawn")
+    start = context.Barrier(4)
+    workers = [context.Process(target=increment, args=(str(path), start, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0, 0, 0, 0]
+    store = Store(SqliteBackend("sqlite:///" + str(tmp_path / "patients.db"), table="patients"))
+    store.load()
+    try:
+        assert store.get("P001") == {"age": 237}
+    finally:
+        store.close()
+
+
+def test_binary_snapshot_keeps_the_record_order(tmp_path):
+    layout = Layout([("name", str), ("age", int)])
+    records = {"P001": {"name": "a", "age": 1}, "P011": {"name": "b"}, "P002": {"name": "c", "age": 3}, "P100": {"age": "x"}, "P003": {"name": "d", "age": 4}}
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps(records))
+    backend = JsonBackend(str(path), snapshot_format="binary", layout=layout)
+    store = Store(backend, layout=layout)
+    store.load()
+    try:
+        assert list(store.all()) == list(records)
+    finally:
+        store.close()
+    snapshot = binary.SnapshotFile(backend.binary_path)
+    try:
+        assert list(snapshot.to_dict()) == list(records)
+    finally:
+        snapshot.close()
+    # back to JSON, the file is rewritten from the binary snapshot in the same order
+    os.utime(backend.binary_path, ns=(1 << 62, 1 << 62))
+    JsonBackend(str(path)).convert()
+    assert list(json.loads(path.read_text())) == list(records)
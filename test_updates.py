@@ -0,0 +1,24 @@
+'''Tests of the update fast paths of the patient and student apps.'''
+import importlib.util
+import os
+
+import main as patients
+
+spec = importlib.util.spec_from_file_location("students_main", os.path.join(os.path.dirname(__file__), "Student Score FastAPI", "main.py"))
+students = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(students)
+
+
+def test_patient_update_recomputes_stale_bmi_and_verdict():
+    stored = {"name": "John Doe", "age": 29, "gender": "Male", "city": "New York", "weight": 59.0, "height": 174.0, "bmi": 0.0, "verdict": "Underweight"}
+    updated = patients.merge_update("P011", stored, patients.Update_patient(name="John Roe"))
+    assert updated == {**stored, "name": "John Roe", "bmi": 19.49, "verdict": "Normal weight"}
+    assert stored["bmi"] == 0.0
+
+
+def test_student_update_recomputes_stale_derived_fields():
+    stored = {"name": "Ann", "scores": [90, 70], "user_name": "AnnS001", "max_score": 0, "avg_score": 0, "grade": "Fail"}
+    updated = students.merge_student(students.Update_student(id="S001", name="Anna"), stored)
+    full = students.Student(id="S001", name="Anna", scores=[90, 70]).model_dump(exclude={"id"})
+    assert updated == full
+    assert updated["grade"] == "B"